@@ -7,17 +7,26 @@ Created on Thu Aug 24 12:59:29 2017
 
 @author: paul.herringer
 """
+import hashlib
+import json
+import os
+from multiprocessing import Pool, shared_memory
+
 import numpy as np
 import progressbar as pb
+import scipy.sparse as sp
 
-from cnn.gte import calc_GTE
+from cnn.gte import calc_GTE, get_conditioning, iter_GTE_fused
+from cnn.utils import PackedSpikes
 
 
 def estimate_parents(D, verbose=1, **params):
     """Estimates the strongest drivers of each neuron using GTE.
     
     Args:
-        D: Spike or fluorescence data in shape (neurons, timesteps).
+        D: Spike or fluorescence data in shape (neurons, timesteps), 
+            binary spikes as a utils.PackedSpikes object, or spikes as a
+            scipy sparse matrix.
         verbose: Control what gets printed to the console.
         **CL: Conditioning level.
         **k: Maximum time lag to consider.
@@ -28,12 +37,26 @@ def estimate_parents(D, verbose=1, **params):
             the histogram of average activity.
         **num_parents: Number of parents to record for each variable. 
             Parents are chosen by largest GTE score.
+        **block_size: If given, the GTE PDF is generated in blocks of this
+            many sending neurons to bound memory use. If return_scores is 
+            False, this is the number of sending neurons whose scores are
+            held at a time, 16 by default.
+        **fused: Whether to reduce the PDF of each sending neuron to GTE
+            scores as soon as it is generated.
+        **n_jobs: Number of worker processes to use for GTE.
+        **state_dtype: Integer type used to store the GTE state indices,
+            or 'auto' for the narrowest type that fits.
+        **return_scores: Whether to keep and return the full matrix of GTE
+            scores. If False, parents are selected from blocks of scores 
+            as they are calculated by the fused GTE kernel, so memory use 
+            is proportional to neurons*num_parents.
         
     Returns:
         parents: Dict of parents for each neuron. Keys are the index
         of the recieving neuron, values are the indices of the strongest
         drivers.
         scores: Adjacency matrix of GTE scores, shape (neurons, neurons).
+            None if return_scores is False.
     """
     # Parameters
     CL = params.setdefault('CL', 0.25)
@@ -41,42 +64,145 @@ def estimate_parents(D, verbose=1, **params):
     IFT = params.setdefault('IFT', True)
     estimate_CL = params.setdefault('estimate_CL', False)
     num_parents = params.setdefault('num_parents', 3)
+    block_size = params.setdefault('block_size', None)
+    fused = params.setdefault('fused', False)
+    n_jobs = params.setdefault('n_jobs', 1)
+    return_scores = params.setdefault('return_scores', True)
+    state_dtype = params.setdefault('state_dtype', 'auto')
     
     if verbose > 0:
         print('Estimating parents using GTE')
     
-    # Cast D to only two bins for activity level
-    D = np.greater(D, 0)
+    # Cast D to only two bins for activity level. Packed spikes are already
+    # binary, and are passed to GTE without transposing. Sparse spikes are
+    # packed rather than densified.
+    if isinstance(D, PackedSpikes):
+        D_ = D
+    elif sp.issparse(D):
+        D_ = PackedSpikes.from_sparse(D)
+    else:
+        D_ = np.greater(D, 0).T
     parents = dict()
-    scores = calc_GTE(
-        D.T, CL=CL, k=k, IFT=IFT, estimate_CL=estimate_CL, verbose=verbose)
     
-    for i in range(scores.shape[0]):
-        p = (-scores[:,i]).argsort()[:num_parents]
-        parents[i] = p
+    if return_scores:
+        scores = calc_GTE(
+            D_, CL=CL, k=k, IFT=IFT, estimate_CL=estimate_CL, 
+            block_size=block_size, fused=fused, n_jobs=n_jobs, 
+            state_dtype=state_dtype, verbose=verbose)
+        top = _top_parents(scores, num_parents)
+    
+    else:
+        scores = None
+        G = get_conditioning(
+            D_, CL=CL, estimate_CL=estimate_CL, verbose=verbose)
+        
+        # Scores and indices of the strongest drivers found so far
+        top = np.zeros((0, D.shape[0]), dtype=np.int64)
+        top_scores = np.zeros((0, D.shape[0]))
+        
+        for rows, block in iter_GTE_fused(
+                D_, G, k=k, IFT=IFT, n_jobs=n_jobs, state_dtype=state_dtype,
+                block_size=block_size or 16, verbose=verbose):
+            top_scores = np.concatenate((top_scores, block), axis=0)
+            top = np.concatenate((top, np.broadcast_to(
+                np.arange(rows.start, rows.stop)[:,None], block.shape)))
+            idx = _top_parents(top_scores, num_parents)
+            top_scores = np.take_along_axis(top_scores, idx, axis=0)
+            top = np.take_along_axis(top, idx, axis=0)
+        
+    for i in range(D.shape[0]):
+        parents[i] = top[:,i]
         
     return parents, scores
 
 
+def _top_parents(scores, num_parents):
+    """Finds the rows with the largest scores in each column, in order of
+    decreasing score, without sorting the full columns.
+    
+    Args:
+        scores: Array of GTE scores, shape (sending neurons, neurons).
+        num_parents: Number of rows to find for each column.
+        
+    Returns:
+        top: Array of row indices, shape (num_parents, neurons).
+    """
+    if scores.shape[0] > num_parents:
+        top = np.argpartition(-scores, num_parents - 1, axis=0)
+        top = top[:num_parents]
+    else:
+        top = np.broadcast_to(
+            np.arange(scores.shape[0])[:,None], scores.shape)
+        
+    order = np.argsort(-np.take_along_axis(scores, top, axis=0), axis=0)
+    
+    return np.take_along_axis(top, order, axis=0)
+
+
+def candidate_pairs(scores, top_m=None, percentile=None):
+    """Selects the most likely connections according to GTE, so that the
+    CNN only needs to score these pairs.
+    
+    Args:
+        scores: Adjacency matrix of GTE scores, shape (neurons, neurons),
+            as returned by estimate_parents.
+        top_m: Number of sending neurons with the largest GTE scores to 
+            select for each recieving neuron.
+        percentile: If given instead of top_m, all pairs with a GTE score 
+            at or above this percentile of the scores are selected.
+            
+    Returns:
+        pairs: Boolean mask of selected (sending, recieving) pairs, 
+            shape (neurons, neurons). The diagonal is never selected.
+    """
+    if (top_m is None) == (percentile is None):
+        raise ValueError('Exactly one of top_m and percentile must be given')
+        
+    off_diag = ~np.eye(scores.shape[0], dtype=bool)
+    pairs = np.zeros(scores.shape, dtype=bool)
+    
+    if top_m is not None:
+        scores_ = np.where(off_diag, scores, -np.inf)
+        top = _top_parents(scores_, min(top_m, scores.shape[0] - 1))
+        pairs[top, np.arange(scores.shape[1])] = True
+    else:
+        thres = np.nanpercentile(scores[off_diag], percentile)
+        pairs[scores >= thres] = True
+        
+    return pairs & off_diag
+
+
 def downsample_spikes(S, thres=150, verbose=1):
     """Downsamples spike data to include only the top 1% of frames
     based on total activity. Based on https://github.com/spoonsso/TFconnect.
     
     Args:
-        S: Spike data in shape (neurons, timesteps).
+        S: Spike data in shape (neurons, timesteps), binary spikes as
+            a utils.PackedSpikes object, or a scipy sparse matrix.
         thres: Threshold for activity at a single time frame. The 
             default works for 1000 neurons.
         
     Returns:
         Downsampled spike data, now of 
-            shape (neurons, downsampled timesteps).
+            shape (neurons, downsampled timesteps). Packed and sparse 
+            spikes are made dense, but only for the selected frames.
     """
-    sum_S = np.sum(S, axis=0)
+    if isinstance(S, PackedSpikes):
+        sum_S = S.sum(axis=0)
+    elif sp.issparse(S):
+        sum_S = np.asarray(S.sum(axis=0)).ravel()
+    else:
+        sum_S = np.sum(S, axis=0)
     if verbose > 0:
         print(
             'Downsampling spike data to {} frames using threshold {}'
             .format(np.sum(np.greater(sum_S, thres)), thres))
     
+    if isinstance(S, PackedSpikes):
+        return S.to_dense(frames=np.greater(sum_S, thres))
+    elif sp.issparse(S):
+        return sp.csc_matrix(S)[:, np.greater(sum_S, thres)].toarray()
+    
     return S[:, np.greater(sum_S, thres)]
 
 
@@ -106,12 +232,115 @@ def downsample_fluorescence(F, thres=20, verbose=1):
     return F[:, np.greater(sum_F, thres)]
 
 
+def parent_means(ds_data, parents):
+    """Computes the average activity of the parents of each neuron.
+    
+    Args:
+        ds_data: Downsampled spike or fluorescence data in shape
+            (neurons, timesteps).
+        parents: Dict of indices indicating the strongest drivers of 
+            each neuron as estimated by GTE.
+            
+    Returns:
+        means: Array of parent activity, shape (neurons, timesteps).
+    """
+    means = np.zeros(ds_data.shape)
+    for n in range(ds_data.shape[0]):
+        means[n] = np.mean(ds_data[parents[n]], axis=0)
+        
+    return means
+
+
+def _sample_class(network, c, size, timesteps, slice_len, rng):
+    """Randomly chooses the neuron pairs and slice start times of size 
+    examples from connection class c."""
+    pairs = np.argwhere(network == c)
+    reps = int(size/pairs.shape[0]) + 1
+    pair_idx = np.repeat(np.arange(pairs.shape[0]), reps)
+    pair_idx = rng.permutation(pair_idx)[:size]
+    start_idx = rng.randint(0, timesteps-slice_len, size=size)
+    
+    return pairs[pair_idx], start_idx
+
+
+def sample_examples(network, timesteps, rng=None, **params):
+    """Randomly chooses the neuron pairs and slice start times of a 
+    balanced set of training examples.
+    
+    Args:
+        network: Adjacency matrix representing the true connections of the
+            neurons in the dataset. Shape (neurons, neurons).
+        timesteps: Number of time steps in the downsampled data.
+        rng: A np.random.RandomState to draw from. Uses the global numpy
+            random state if not given.
+        **classes: List of connection class labels, as integers. Default is
+            [-1, 0, 1] for inhibitory, none, and excitatory connection
+            respectively.
+        **target: Total number of examples to generate from this dataset.
+        **slice_len: Length of time series slice used to generate examples.
+        
+    Returns:
+        pairs: Array of (sending, recieving) neuron indices for each 
+            example, shape (target, 2).
+        start_idx: Array of slice start times, shape (target,).
+        labels: Array of training labels, shape (target, # of classes).
+    """
+    # Parameters
+    classes = params.setdefault('classes', [-1,0,1])
+    target = params.setdefault('target', int(1.2e6))
+    slice_len = params.setdefault('slice_len', 330)
+    
+    assert not target % len(classes)
+    per_class = target//len(classes)
+    if rng is None:
+        rng = np.random
+    
+    pairs = np.zeros((target, 2), dtype=np.int64)
+    start_idx = np.zeros(target, dtype=np.int64)
+    labels = np.zeros((target, len(classes)))
+    
+    for i, c in enumerate(classes):
+        
+        block = slice(i*per_class, (i+1)*per_class)
+        pairs[block], start_idx[block] = _sample_class(
+            network, c, per_class, timesteps, slice_len, rng)
+        labels[block] = np.equal(classes, c, dtype=np.int32)
+        
+    return pairs, start_idx, labels
+
+
+def assemble_examples(ds_data, G, means, pairs, start_idx, out):
+    """Gathers the data slices of a set of examples into an array.
+    
+    Args:
+        ds_data: Downsampled spike or fluorescence data in shape
+            (neurons, timesteps).
+        G: Average activity of the network, shape (timesteps,).
+        means: Average activity of the parents of each neuron, as 
+            computed by parent_means.
+        pairs: Array of (sending, recieving) neuron indices for each 
+            example, shape (examples, 2).
+        start_idx: Array of slice start times, shape (examples,).
+        out: Array to hold the examples, shape (examples, 5, slice_len, 1).
+    """
+    time_idx = start_idx[:,None] + np.arange(out.shape[2])
+    n1 = pairs[:,0,None]
+    n2 = pairs[:,1,None]
+    
+    out[:,0,:,0] = means[n1, time_idx]
+    out[:,1,:,0] = ds_data[n1, time_idx]
+    out[:,2,:,0] = G[time_idx]
+    out[:,3,:,0] = ds_data[n2, time_idx]
+    out[:,4,:,0] = means[n2, time_idx]
+
+
 def get_examples(ds_data, network, parents, verbose=1, **params):
     """Generates a balanced set of training examples from a single dataset.
     
     Args:
         ds_data: Downsampled spike or fluorescence data in shape
-            (neurons, timesteps).
+            (neurons, timesteps), as an array or a scipy sparse matrix.
+            Sparse data is made dense, which is cheap after downsampling.
         network: Adjacency matrix representing the true connections of the
             neurons in the dataset. Shape (neurons, neurons).
         parents: Dict of indices indicating the strongest drivers of 
@@ -122,6 +351,9 @@ def get_examples(ds_data, network, parents, verbose=1, **params):
             respectively.
         **target: Total number of examples to generate from this dataset.
         **slice_len: Length of time series slice used to generate examples.
+        **chunk_size: Number of examples to assemble at a time.
+        **dtype: Data type of the examples and labels. Keras models use 
+            float32, so other types are converted on every call.
         
     Returns:
         examples: Array of training examples, shape (target, 5, slice_len, 1).
@@ -131,13 +363,21 @@ def get_examples(ds_data, network, parents, verbose=1, **params):
     classes = params.setdefault('classes', [-1,0,1])
     target = params.setdefault('target', int(1.2e6))
     slice_len = params.setdefault('slice_len', 330)
+    chunk_size = params.setdefault('chunk_size', 10000)
+    dtype = params.setdefault('dtype', np.float32)
     
-    assert not target % len(classes)
+    if sp.issparse(ds_data):
+        ds_data = ds_data.toarray()
    
     G = np.mean(ds_data, axis=0)   
-    examples = np.zeros((target, 5, slice_len, 1))
-    labels = np.zeros((target, len(classes)))
-    count = 0
+    means = parent_means(ds_data, parents)
+    pairs, start_idx, labels = sample_examples(
+        network, ds_data.shape[1], **params)
+    assert (network[pairs[:,0], pairs[:,1]] == 
+            np.array(classes)[np.argmax(labels, axis=1)]).all()
+    
+    examples = np.zeros((target, 5, slice_len, 1), dtype=dtype)
+    labels = labels.astype(dtype)
     
     if verbose > 0:
         print('Generating {} training examples'.format(target))
@@ -146,40 +386,15 @@ def get_examples(ds_data, network, parents, verbose=1, **params):
                                       pb.Bar(), ' - ',
                                       pb.ETA()])
     
-    for c in classes:
+    for start in range(0, target, chunk_size):
         
-        pairs = np.argwhere(network == c)
-        reps = int(target/len(classes)/pairs.shape[0]) + 1
-        pair_idx = np.repeat(np.arange(pairs.shape[0]), reps)
-        pair_idx = np.random.permutation(pair_idx)[:target//len(classes)]
-        start_idx = np.random.randint(
-            0, ds_data.shape[1]-slice_len, size=target//len(classes))
+        chunk = slice(start, start + chunk_size)
+        assemble_examples(
+            ds_data, G, means, pairs[chunk], start_idx[chunk], 
+            examples[chunk])
         
-        for i in range(pair_idx.size):
-            
-            n1 = pairs[pair_idx[i]][0]
-            n2 = pairs[pair_idx[i]][1]
-            assert(network[n1,n2] == c)
-            
-            start = start_idx[i]
-            end = start + slice_len
-            
-            p1 = np.mean(ds_data[parents[n1], start:end], axis=0)
-            p2 = np.mean(ds_data[parents[n2], start:end], axis=0)
-            
-            examples[count,:,:,0] = np.vstack((
-                                        p1, 
-                                        ds_data[n1][start:end], 
-                                        G[start:end], 
-                                        ds_data[n2][start:end], 
-                                        p2
-                                        ))
-            
-            labels[count,:] = np.equal(classes, c, dtype=np.int32)
-            
-            if verbose > 0:
-                bar.update(count)
-            count +=1
+        if verbose > 0:
+            bar.update(min(start + chunk_size, target))
         
     if verbose > 0:
         bar.finish()
@@ -193,6 +408,176 @@ def get_examples(ds_data, network, parents, verbose=1, **params):
     return examples, labels
 
 
+def _generate_serial(datasets, networks, parents, verbose=1, **params):
+    """Generates the examples of generate_dataset one dataset at a time,
+    drawing from the global numpy random state."""
+    # Parameters
+    classes = params['classes']
+    data_type = params['data_type']
+    thres = params['thres']
+    ex_per_netw = params['target']
+    slice_len = params['slice_len']
+    dtype = params['dtype']
+    
+    examples = np.zeros(
+        (ex_per_netw*len(datasets), 5, slice_len, 1), dtype=dtype)
+    labels = np.zeros((ex_per_netw*len(datasets), len(classes)), dtype=dtype)
+    
+    for i in range(len(datasets)):
+        
+        if verbose > 0:
+            print('Network {} of {}'.format(i+1, len(datasets)))
+            
+        data = datasets[i]
+        network = networks[i]
+        parents_ = parents[i]
+        
+        ds_data = _downsample(
+            data, data_type=data_type, thres=thres, verbose=verbose)
+            
+        start = i*ex_per_netw
+        end = (i+1)*ex_per_netw
+        examples[start:end], labels[start:end] = get_examples(
+            ds_data, network, parents_, verbose=verbose, **params)
+        
+    return examples, labels
+
+
+def _example_block(examples, labels, sources, networks, task, **params):
+    """Generates the examples of a single dataset and class into their
+    place in the output arrays of generate_dataset.
+    
+    Args:
+        examples: Output array for all examples.
+        labels: Output array for all labels.
+        sources: List of (ds_data, G, means) tuples for each dataset.
+        networks: List of adjacency matrices of the datasets.
+        task: Tuple of (dataset index, class index, seed).
+        
+        Also accepts **params for data_processing.get_examples.
+        
+    Returns:
+        size: Number of examples generated.
+    """
+    # Parameters
+    classes = params['classes']
+    ex_per_netw = params['target']
+    slice_len = params['slice_len']
+    chunk_size = params.setdefault('chunk_size', 10000)
+    
+    d, c, seed = task
+    ds_data, G, means = sources[d]
+    size = ex_per_netw//len(classes)
+    offset = d*ex_per_netw + c*size
+    
+    pairs, start_idx = _sample_class(
+        networks[d], classes[c], size, ds_data.shape[1], slice_len, 
+        np.random.RandomState(seed))
+    
+    for start in range(0, size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        assemble_examples(
+            ds_data, G, means, pairs[chunk], start_idx[chunk], 
+            examples[offset+start:offset+min(start + chunk_size, size)])
+        
+    labels[offset:offset+size] = np.equal(classes, classes[c])
+    
+    return size
+
+
+# Arrays shared with the worker processes of generate_dataset
+_shared = dict()
+
+
+def _init_block_worker(arrays, sources, networks, params):
+    """Attaches a worker process of generate_dataset to the shared output
+    arrays."""
+    for name, (shm_name, shape, dtype) in arrays.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared[name + '_shm'] = shm
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        
+    _shared['args'] = (sources, networks)
+    _shared['params'] = params
+
+
+def _block_worker(task):
+    """Generates a block of examples in a worker process."""
+    return _example_block(
+        _shared['examples'], _shared['labels'], *_shared['args'], 
+        task=task, **_shared['params'])
+
+
+def _generate_blocks(sources, networks, seeds, shms, verbose=1, **params):
+    """Generates the examples of generate_dataset in blocks of a single
+    dataset and class, each with its own seeded random state. With 
+    n_jobs > 1 the blocks are generated by worker processes that write 
+    into output arrays in shared memory. The shared memory blocks are 
+    appended to shms, and must be released by the caller once the output
+    arrays are no longer needed."""
+    # Parameters
+    classes = params['classes']
+    ex_per_netw = params['target']
+    slice_len = params['slice_len']
+    dtype = params['dtype']
+    n_jobs = params['n_jobs']
+    
+    assert not ex_per_netw % len(classes)
+    
+    target = ex_per_netw*len(sources)
+    tasks = [(d, c, seeds[d*len(classes) + c]) 
+             for d in range(len(sources)) for c in range(len(classes))]
+    
+    if verbose > 0:
+        print('Generating {} training examples in {} blocks'
+              .format(target, len(tasks)))
+        count = 0
+        bar = pb.ProgressBar(max_value=target,
+                             widgets=[pb.Percentage(), ' - ',
+                                      pb.Bar(), ' - ',
+                                      pb.ETA()])
+    
+    if n_jobs > 1:
+        
+        arrays = dict()
+        outputs = []
+        for name, shape in zip(
+                ['examples', 'labels'], 
+                [(target, 5, slice_len, 1), (target, len(classes))]):
+            size = int(np.prod(shape))*np.dtype(dtype).itemsize
+            shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+            shms.append(shm)
+            outputs.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+            outputs[-1][:] = 0
+            arrays[name] = (shm.name, shape, dtype)
+        examples, labels = outputs
+        
+        with Pool(n_jobs, initializer=_init_block_worker, 
+                  initargs=(arrays, sources, networks, params)) as pool:
+            for size in pool.imap_unordered(_block_worker, tasks):
+                if verbose > 0:
+                    count += size
+                    bar.update(count)
+    
+    else:
+        
+        examples = np.zeros((target, 5, slice_len, 1), dtype=dtype)
+        labels = np.zeros((target, len(classes)), dtype=dtype)
+        
+        for task in tasks:
+            size = _example_block(
+                examples, labels, sources, networks, task, **params)
+            if verbose > 0:
+                count += size
+                bar.update(count)
+                
+    if verbose > 0:
+        bar.finish()
+        
+    assert not np.isnan(examples).any()
+    return examples, labels
+
+
 def generate_dataset(
     datasets, networks, parents, mode='train', mean=None, 
     verbose=1, **params):
@@ -224,6 +609,17 @@ def generate_dataset(
         **target: Total number of examples to generate from this dataset.
         **valid_split: Fraction of data to hold apart for validation.
         **slice_len: Length of time series slice used to generate examples.
+        **dtype: Data type of the examples, labels and mean.
+        **n_jobs: Number of worker processes. Each combination of dataset
+            and class is generated by a worker, which writes its examples
+            straight into a shared output array.
+        **block_seed: Seed for the random number generators of the 
+            worker processes. Each combination of dataset and class draws
+            from its own seeded stream, so the examples are the same for
+            any value of n_jobs. If neither n_jobs > 1 nor block_seed are
+            given, the global numpy random state is used as before, and 
+            the examples match generate_index and generate_store with the
+            same global seed.
         
         Also accepts **params for data_processing.estimate_parents and 
         data_processing.get_examples. Params for estimate_parents are 
@@ -248,38 +644,51 @@ def generate_dataset(
     target = params.setdefault('target', int(1.2e6))
     valid_split = params.setdefault('valid_split', 0.1)
     slice_len = params.setdefault('slice_len', 330)
+    dtype = params.setdefault('dtype', np.float32)
+    n_jobs = params.setdefault('n_jobs', 1)
+    block_seed = params.setdefault('block_seed', None)
     
     assert len(datasets) == len(networks) == len(parents)
-    examples = np.zeros((target, 5, slice_len, 1))
-    labels = np.zeros((target, len(classes)))
     ex_per_netw = target//len(datasets)
     params['target'] = ex_per_netw
     
-    for i in range(len(datasets)):
+    if n_jobs > 1 or block_seed is not None:
         
-        if verbose > 0:
-            print('Network {} of {}'.format(i+1, len(datasets)))
+        sources = []
+        for i in range(len(datasets)):
+            ds_data = _downsample(
+                datasets[i], data_type=data_type, thres=thres, 
+                verbose=verbose)
+            sources.append((ds_data, np.mean(ds_data, axis=0), 
+                            parent_means(ds_data, parents[i])))
             
-        data = datasets[i]
-        network = networks[i]
-        parents_ = parents[i]
+        # One seed per block of examples, plus one for the final shuffle
+        seeds = np.random.SeedSequence(block_seed).generate_state(
+            len(datasets)*len(classes) + 1)
+        rng = np.random.RandomState(seeds[-1])
         
-        if data_type == 'spikes':
-            ds_data = downsample_spikes(data, thres=thres, verbose=verbose)
-        elif data_type == 'fluorescence':
-            ds_data = downsample_fluorescence(
-                data, thres=thres, verbose=verbose)
-        else:
-            raise ValueError('Invalid data type')
+        shms = []
+        try:
+            examples, labels = _generate_blocks(
+                sources, networks, seeds[:-1], shms, verbose=verbose, 
+                **params)
             
-        start = i*ex_per_netw
-        end = (i+1)*ex_per_netw
-        examples[start:end], labels[start:end] = get_examples(
-            ds_data, network, parents_, verbose=verbose, **params)
-    
-    shuffle_idx = np.random.permutation(np.arange(examples.shape[0]))
-    examples = examples[shuffle_idx]
-    labels = labels[shuffle_idx]
+            shuffle_idx = rng.permutation(np.arange(examples.shape[0]))
+            examples = examples[shuffle_idx]
+            labels = labels[shuffle_idx]
+            
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        
+    else:
+        examples, labels = _generate_serial(
+            datasets, networks, parents, verbose=verbose, **params)
+        
+        shuffle_idx = np.random.permutation(np.arange(examples.shape[0]))
+        examples = examples[shuffle_idx]
+        labels = labels[shuffle_idx]
     
     if mode == 'train':
         
@@ -287,7 +696,8 @@ def generate_dataset(
         ex_valid, ex_train = np.split(examples, [idx], axis=0)
         lbl_valid, lbl_train = np.split(labels, [idx], axis=0)
         
-        mean = np.mean(ex_train, axis=0)
+        # Accumulate in float64 in case the examples are lower precision
+        mean = np.mean(ex_train, axis=0, dtype=np.float64).astype(dtype)
         ex_train -= mean
         ex_valid -= mean
         
@@ -295,13 +705,333 @@ def generate_dataset(
     
     elif mode == 'test':
         
-        assert mean != None
-        examples -= mean
+        assert mean is not None
+        examples -= mean.astype(dtype)
         
         return examples, labels
     
     else:
         raise ValueError('Invalid mode')
 
+
+def _downsample(data, data_type='spikes', thres=150.0, verbose=1):
+    """Downsamples spike or fluorescence data."""
+    if data_type == 'spikes':
+        return downsample_spikes(data, thres=thres, verbose=verbose)
+    elif data_type == 'fluorescence':
+        return downsample_fluorescence(data, thres=thres, verbose=verbose)
+    else:
+        raise ValueError('Invalid data type')
+
+
+def generate_index(
+    datasets, networks, parents, mode='train', verbose=1, **params):
+    """Samples a balanced set of training examples from one or more 
+    datasets, in the same way as generate_dataset, but only records where
+    each example comes from. Examples are assembled on demand with 
+    assemble_batch, so memory use is proportional to the size of the 
+    downsampled datasets rather than the number of examples. The random 
+    draws are the same as in generate_dataset, so with the same seed both 
+    give the same examples.
+    
+    Args:
+        datasets: List of full spike or fluorescence datasets. Each dataset
+            should be of shape (neurons, timesteps).
+        networks: List of adjacency matrices representing the true 
+            connections between neurons in each dataset.
+        parents: List of dicts that contain indices for the strongest 
+            drivers of each neuron in the corresponding dataset.
+        mode: Either 'train' or 'test'. In train mode the examples are
+            split into training and validation sets, and the mean of the
+            training examples is computed in chunks.
+        verbose: Control what gets printed to the console.
+        **data_type: Either spikes or fluorescence.
+        **thres: Threshold for downsampling data.
+        **target: Total number of examples to generate.
+        **valid_split: Fraction of data to hold apart for validation.
+        **slice_len: Length of time series slice used to generate examples.
+        **chunk_size: Number of examples to assemble at a time when 
+            computing the mean.
+        **dtype: Data type of the labels and mean, which is also used for
+            examples assembled from the index.
+        
+        Also accepts **params for data_processing.sample_examples.
+        
+    Returns:
+        In train mode:
+            sources: List of (ds_data, G, means) tuples for each dataset.
+            idx_train: Array of training example locations, see below.
+            idx_valid: Array of validation example locations.
+            lbl_train: Array of training labels.
+            lbl_valid: Array of validation labels.
+            mean: Array, mean of training examples over axis 0.
+        In test mode:
+            sources: List of (ds_data, G, means) tuples for each dataset.
+            index: Array of example locations, shape (examples, 4). Each
+                row holds the dataset, sending neuron, recieving neuron and
+                slice start time of an example.
+            labels: Array of labels.
+    """
+    # Parameters
+    data_type = params.setdefault('data_type', 'spikes')
+    thres = params.setdefault('thres', 150.0)
+    target = params.setdefault('target', int(1.2e6))
+    valid_split = params.setdefault('valid_split', 0.1)
+    slice_len = params.setdefault('slice_len', 330)
+    chunk_size = params.setdefault('chunk_size', 10000)
+    dtype = params.setdefault('dtype', np.float32)
+    
+    assert len(datasets) == len(networks) == len(parents)
+    ex_per_netw = target//len(datasets)
+    params['target'] = ex_per_netw
+    
+    sources = []
+    index = []
+    labels = []
+    
+    for i in range(len(datasets)):
+        
+        if verbose > 0:
+            print('Network {} of {}'.format(i+1, len(datasets)))
+            
+        ds_data = _downsample(
+            datasets[i], data_type=data_type, thres=thres, verbose=verbose)
+        sources.append((ds_data, np.mean(ds_data, axis=0), 
+                        parent_means(ds_data, parents[i])))
+        
+        pairs, start_idx, labels_ = sample_examples(
+            networks[i], ds_data.shape[1], **params)
+        index.append(np.column_stack(
+            (np.full(ex_per_netw, i), pairs, start_idx)))
+        labels.append(labels_)
+        
+    index = np.concatenate(index)
+    labels = np.concatenate(labels).astype(dtype)
+        
+    shuffle_idx = np.random.permutation(np.arange(index.shape[0]))
+    index = index[shuffle_idx]
+    labels = labels[shuffle_idx]
+    
+    if mode == 'train':
+        
+        idx = int(index.shape[0]*valid_split)
+        idx_valid, idx_train = np.split(index, [idx], axis=0)
+        lbl_valid, lbl_train = np.split(labels, [idx], axis=0)
+        
+        if verbose > 0:
+            print('Computing mean of {} training examples'
+                  .format(idx_train.shape[0]))
+        
+        mean = np.zeros((5, slice_len, 1))
+        batch = np.zeros((chunk_size, 5, slice_len, 1), dtype=dtype)
+        for start in range(0, idx_train.shape[0], chunk_size):
+            chunk = idx_train[start:start + chunk_size]
+            assemble_batch(sources, chunk, batch[:chunk.shape[0]])
+            mean += np.sum(batch[:chunk.shape[0]], axis=0, dtype=np.float64)
+        mean = (mean/idx_train.shape[0]).astype(dtype)
+        
+        return sources, idx_train, idx_valid, lbl_train, lbl_valid, mean
+    
+    elif mode == 'test':
+        return sources, index, labels
+    
+    else:
+        raise ValueError('Invalid mode')
+
+
+def assemble_batch(sources, index, out):
+    """Assembles examples from one or more datasets on demand.
+    
+    Args:
+        sources: List of (ds_data, G, means) tuples for each dataset, as 
+            returned by generate_index.
+        index: Array of example locations, shape (examples, 4), as 
+            returned by generate_index.
+        out: Array to hold the examples, shape (examples, 5, slice_len, 1).
+    """
+    for d in np.unique(index[:,0]):
+        
+        mask = index[:,0] == d
+        ds_data, G, means = sources[d]
+        
+        examples = np.zeros((np.sum(mask),) + out.shape[1:], dtype=out.dtype)
+        assemble_examples(
+            ds_data, G, means, index[mask,1:3], index[mask,3], examples)
+        out[mask] = examples
+
+
+def _hash_data(fingerprint, data, chunk_size=1<<24):
+    """Updates a hashlib object with the full contents of a dataset, a 
+    chunk of about chunk_size bytes at a time so that no dense copy of
+    the dataset is made."""
+    if isinstance(data, PackedSpikes):
+        kind, arrays = 'packed', [data.bits]
+    elif sp.issparse(data):
+        # Equal sparse matrices can be stored differently, so hash them in
+        # canonical form
+        data = sp.csr_matrix(data, copy=True)
+        data.sum_duplicates()
+        data.eliminate_zeros()
+        kind, arrays = 'sparse', [data.data, data.indices, data.indptr]
+    else:
+        kind, arrays = 'dense', [np.asarray(data)]
+    fingerprint.update(str((kind, tuple(data.shape))).encode())
+    
+    for array in arrays:
+        fingerprint.update(str((array.dtype.str, array.shape)).encode())
+        if array.ndim == 0 or array.size == 0:
+            fingerprint.update(np.ascontiguousarray(array).tobytes())
+            continue
+        step = max(1, chunk_size//max(1, array[:1].nbytes))
+        for start in range(0, array.shape[0], step):
+            fingerprint.update(
+                np.ascontiguousarray(array[start:start + step]).tobytes())
+
+
+def store_manifest(datasets, networks, parents, seed=None, **params):
+    """Describes a training set that has been or will be written to disk
+    with generate_store, so that stored training sets can be matched to 
+    the data and params they were generated from.
+    
+    Args:
+        datasets: List of full spike or fluorescence datasets.
+        networks: List of adjacency matrices of the datasets.
+        parents: List of dicts of the strongest drivers of each neuron.
+        seed: Seed for the numpy random number generator.
+        
+        Also accepts **params for data_processing.generate_index.
+        
+    Returns:
+        manifest: Dict of the data params, seed and a fingerprint of the 
+            input data. Can be saved as JSON.
+    """
+    # Parameters
+    classes = params.setdefault('classes', [-1,0,1])
+    data_type = params.setdefault('data_type', 'spikes')
+    thres = params.setdefault('thres', 150.0)
+    target = params.setdefault('target', int(1.2e6))
+    valid_split = params.setdefault('valid_split', 0.1)
+    slice_len = params.setdefault('slice_len', 330)
+    dtype = params.setdefault('dtype', np.float32)
+    
+    fingerprint = hashlib.sha1()
+    for data, network, parents_ in zip(datasets, networks, parents):
+        _hash_data(fingerprint, data)
+        fingerprint.update(np.ascontiguousarray(network).tobytes())
+        for n in sorted(parents_):
+            fingerprint.update(np.asarray(parents_[n]).tobytes())
+    
+    return {
+        'params':{
+            'classes':[int(c) for c in classes],
+            'data_type':data_type,
+            'thres':float(thres),
+            'target':int(target),
+            'valid_split':float(valid_split),
+            'slice_len':int(slice_len),
+            'dtype':np.dtype(dtype).name
+            },
+        'seed':seed,
+        'fingerprint':fingerprint.hexdigest()
+        }
+
+
+def generate_store(
+    store_dir, datasets, networks, parents, seed=None, verbose=1, **params):
+    """Generates a training set like generate_dataset in train mode, and 
+    writes it to disk as .npy files that can be memory mapped. Examples 
+    are assembled and zero centered in chunks directly into the files, so
+    the full training set is never held in memory. Training runs can then
+    share the stored set through the page cache instead of regenerating 
+    it.
+    
+    Args:
+        store_dir: Directory to write the training set to. A manifest 
+            describing the data params and seed is saved alongside.
+        datasets: List of full spike or fluorescence datasets.
+        networks: List of adjacency matrices of the datasets.
+        parents: List of dicts of the strongest drivers of each neuron.
+        seed: Seed for the numpy random number generator. If given, the
+            stored training set can be regenerated exactly.
+        verbose: Control what gets printed to the console.
+        
+        Also accepts **params for data_processing.generate_index.
+        
+    Returns:
+        Same as load_store.
+    """
+    # Parameters
+    slice_len = params.setdefault('slice_len', 330)
+    chunk_size = params.setdefault('chunk_size', 10000)
+    dtype = params.setdefault('dtype', np.float32)
+    
+    manifest = store_manifest(datasets, networks, parents, seed=seed, **params)
+    
+    if seed is not None:
+        np.random.seed(seed)
+        
+    sources, idx_train, idx_valid, lbl_train, lbl_valid, mean = \
+        generate_index(
+            datasets, networks, parents, mode='train', verbose=verbose, 
+            **params)
+    
+    # The manifest is removed first and written last, so that an 
+    # interrupted run never leaves a store that looks valid
+    manifest_file = os.path.join(store_dir, 'manifest.json')
+    os.makedirs(store_dir, exist_ok=True)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    
+    for name, index in zip(['ex_train', 'ex_valid'], [idx_train, idx_valid]):
+        
+        if verbose > 0:
+            print('Writing {} examples to {}'.format(
+                index.shape[0], os.path.join(store_dir, name + '.npy')))
+        
+        examples = np.lib.format.open_memmap(
+            os.path.join(store_dir, name + '.npy'), mode='w+', dtype=dtype,
+            shape=(index.shape[0], 5, slice_len, 1))
+        
+        for start in range(0, index.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            assemble_batch(sources, index[chunk], examples[chunk])
+            examples[chunk] -= mean
+            
+        examples.flush()
+        del examples
+    
+    for name, array in zip(['lbl_train', 'lbl_valid', 'mean'],
+                           [lbl_train, lbl_valid, mean]):
+        np.save(os.path.join(store_dir, name + '.npy'), array)
+    
+    with open(manifest_file, 'w') as outf:
+        json.dump(manifest, outf, sort_keys=True)
+    
+    return load_store(store_dir)
+    
+
+def load_store(store_dir, mmap_mode='r'):
+    """Loads a training set written by generate_store.
+    
+    Args:
+        store_dir: Directory the training set was written to.
+        mmap_mode: Memory map mode for the examples, see np.load.
+        
+    Returns:
+        ex_train: Array of training examples, zero centered.
+        ex_valid: Array of validation examples, zero centered.
+        lbl_train: Array of training labels.
+        lbl_valid: Array of validation labels.
+        mean: Array, mean of training examples over axis 0.
+        manifest: Dict describing the data params and seed.
+    """
+    with open(os.path.join(store_dir, 'manifest.json'), 'r') as inf:
+        manifest = json.load(inf)
     
+    arrays = []
+    for name in ['ex_train', 'ex_valid', 'lbl_train', 'lbl_valid', 'mean']:
+        arrays.append(np.load(
+            os.path.join(store_dir, name + '.npy'), 
+            mmap_mode=mmap_mode if name.startswith('ex') else None))
         
+    return tuple(arrays) + (manifest,)
@@ -5,70 +5,103 @@ Created on Thu Aug 24 16:03:39 2017
 
 @author: paul.herringer
 """
-import warnings
+from multiprocessing import Pool, shared_memory
 
 import numpy as np
 import progressbar as pb
 
+from cnn.utils import PackedSpikes
 
-def calc_PDF(D, G, k=2, IFT=True, verbose=1):    
-    """Generates a probability density function matrix for caluclating GTE.
+
+# Maximum number of state indices histogrammed in a single bincount call
+_max_codes = int(1e7)
+
+
+def _data_shape(D):
+    """Returns the shape of the data as (timesteps, neurons). Packed 
+    spikes are stored as (neurons, timesteps), like all spike data from
+    utils.read_spike_trains."""
+    if isinstance(D, PackedSpikes):
+        return D.shape[::-1]
+    return D.shape
+
+
+def _state_codes(
+    D, G, k=2, IFT=True, bins=None, levels=None, state_dtype='auto'):
+    """Pre-computes the state index of every neuron at every valid time 
+    sample, which is shared by all the PDF generating functions.
     
     Args:
-        D: Neuron firing data in shape (timesteps, neurons). Data points
-            should be integer values; either spikes or discretized 
-            fluorescence data.
-        G: Vector to condition data on the average activity level of the 
-            network. Should be 1 when avg > conditioning level and 
-            0 when avg < conditioning level.
+        D: Neuron firing data in shape (timesteps, neurons), or packed 
+            binary spikes as described in calc_PDF.
+        G: Conditioning vector, as described in calc_PDF.
         k: Maximum time lag for the PDF to consider.
-        IFT: Whether to include in instant feedback term, that is, to 
-            condition on the present state of the sending variable
-            as well as its past.
-        verbose: Control what gets printed to the console.
+        IFT: Whether to include in instant feedback term.
+        bins: Number of activity levels in the data. Estimated from D
+            if not given.
+        levels: Number of conditioning levels. Estimated from G if not
+            given.
+        state_dtype: Integer type of the state indices, or 'auto' for
+            the narrowest type that holds every state of the PDF.
         
     Returns:
-        P: Array, PDF for computing GTE(i -> j). Order of dimsensions is
-            (jnow, jpast, inow(if IFT), ipast, G, neuron i, neuron j).
-            Total number of dimensions will depend on k and IFT.
+        dims: Array, dimensions of the full joint PDF matrix.
+        mult: Array, multipliers to access the PDF up to but not 
+            including the neuron indices.
+        MD_list_1: Array of state indices for each neuron as reciever,
+            shape (neurons, valid timesteps).
+        MD_list_2: Array of state indices for each neuron as sender,
+            shape (neurons, valid timesteps).
+        multGVector: State indices of the conditioning vector.
     """
     # Important params
-    bins = np.unique(D).size
-    timesteps, neurons = D.shape
+    packed = isinstance(D, PackedSpikes)
+    if bins is None:
+        bins = 2 if packed else np.unique(D).size
+    if levels is None:
+        levels = np.unique(G).size
+    timesteps, neurons = _data_shape(D)
     ndims = 2*k + 1
     if IFT:
         ndims += 1
     
     # Dimensions of the final joint PDF matrix
-    dims = [bins for d in range(ndims)] + [np.unique(G).size, neurons, neurons]
+    dims = [bins for d in range(ndims)] + [levels, neurons, neurons]
     dims = np.array(dims)
     
-    # Vector of increasing values from 0 to the product of all dimensions 
-    # except those that represent the ij neuron
-    Pnumel = np.arange(np.prod(dims[:-2]), dtype=np.int64)
-    minlength = Pnumel.size
-    
-    # This will become the final PDF
-    P = np.zeros(np.prod(dims))
-    
-    # To access entire PDF with a single index (multipliers) or just
-    # up to but not including the neuron indices (mult)
-    multipliers = np.concatenate(([1], np.cumprod(dims[:-1]))).astype(np.int)
-    mult = multipliers[:-2]
+    # To access the PDF up to but not including the neuron indices
+    mult = np.concatenate(([1], np.cumprod(dims[:-3]))).astype(np.int64)
     
-    # Lists to hold pre-computed time samples for all neurons
-    # 1st list is for recieving neuron, 2nd for sending neuron
-    MD_list_1 = []
-    MD_list_2 = []
+    # The sum of the reciever, sender and G indices must also fit 
+    max_state = np.prod(dims[:-2]) - 1
+    if state_dtype == 'auto':
+        state_dtype = np.min_scalar_type(max_state)
+    elif not np.can_cast(np.min_scalar_type(max_state), state_dtype):
+        raise ValueError(
+            'State dtype {} can not hold {} states'
+            .format(np.dtype(state_dtype), max_state + 1))
     
     # Can only use time samples for which we have enough steps into the past
     validSamples = np.arange(k, timesteps)
     
+    # Arrays to hold pre-computed time samples for all neurons, one row
+    # per neuron. 1st is for recieving neuron, 2nd for sending neuron
+    MD_list_1 = np.zeros((neurons, validSamples.size), dtype=state_dtype)
+    MD_list_2 = np.zeros((neurons, validSamples.size), dtype=state_dtype)
+    
     # Array to hold present and past time samples
-    multDi = np.zeros([validSamples.size, k+1])
+    multDi = np.zeros([validSamples.size, k+1], dtype=np.int64)
     
     for i in range(neurons):
         
+        if packed:
+            
+            # With two bins the multipliers are powers of two, so the
+            # state indices can be built by shifting the spike bits
+            MD_list_1[i] = D.lagged_codes(i, k)
+            MD_list_2[i] = D.lagged_codes(i, k, first_lag=1-IFT, shift=k+1)
+            continue
+        
         Di = D[:,i]
         
         # Valid samples for Di, Di(t-1), Di(t-2), etc
@@ -76,55 +109,113 @@ def calc_PDF(D, G, k=2, IFT=True, verbose=1):
             multDi[:,j] = Di[k-j:Di.size-j]
         
         # Di, Di(t-1), etc for recieving neuron, indexed by mult
-        mDi_1 = np.dot(multDi, mult[:k+1])
+        MD_list_1[i] = np.dot(multDi, mult[:k+1])
         
         # IFT, Di(t-1), etc for sending neuron, indexed by mult
-        mDi_2 = np.dot(multDi[:,1-IFT:], mult[k+1:-1])
-        
-        MD_list_1.append(mDi_1)
-        MD_list_2.append(mDi_2)
+        MD_list_2[i] = np.dot(multDi[:,1-IFT:], mult[k+1:-1])
         
-    # Vector of G values for all valid samples, indexed by multipliers
+    # Vector of G values for all valid samples, indexed by mult
     GVector = G[validSamples]
-    multGVector = mult[-1]*GVector
+    multGVector = (mult[-1]*GVector).astype(state_dtype)
+    
+    return dims, mult, MD_list_1, MD_list_2, multGVector
+
+
+def _sender_counts(MD_list_1, MD_list_2, multGVector, i, minlength):
+    """Counts the states of the i --> j connection for a single sending 
+    neuron i and all recieving neurons j at once. The state indices of 
+    each reciever are offset by a multiple of minlength, so that a single
+    bincount call histograms many recievers.
+    
+    Args:
+        MD_list_1: Array of state indices for each neuron as reciever.
+        MD_list_2: Array of state indices for each neuron as sender.
+        multGVector: State indices of the conditioning vector.
+        i: Index of the sending neuron.
+        minlength: Number of states in the PDF of a single ij pair.
+        
+    Returns:
+        counts: Array of state counts, shape (minlength, neurons). The 
+            column for j == i is left empty.
+    """
+    neurons, samples = MD_list_1.shape
+    counts = np.zeros((neurons, minlength), dtype=np.int64)
+    
+    # Sum over multiplied ipast, G, which is shared by all recievers. This
+    # always fits in the type of the state indices
+    indexI = MD_list_2[i] + multGVector
+    
+    # Limit the number of recievers per call to bound the temporary arrays
+    step = max(1, _max_codes//samples)
+    
+    for start in range(0, neurons, step):
+        
+        stop = min(start + step, neurons)
+        
+        # Sum over multiplied jnow, jpast, ipast, G, offset by reciever
+        index = np.add(MD_list_1[start:stop], indexI, dtype=np.int64)
+        index += minlength*np.arange(stop - start, dtype=np.int64)[:,None]
+        
+        counts[start:stop] = np.bincount(
+            index.ravel(), minlength=minlength*(stop - start)
+            ).reshape((stop - start, minlength))
+        
+    counts[i] = 0
+    
+    return counts.T
+
+
+def calc_PDF(D, G, k=2, IFT=True, state_dtype='auto', verbose=1):    
+    """Generates a probability density function matrix for caluclating GTE.
+    
+    Args:
+        D: Neuron firing data in shape (timesteps, neurons). Data points
+            should be integer values; either spikes or discretized 
+            fluorescence data. Binary spikes may also be given as a 
+            utils.PackedSpikes object, shape (neurons, timesteps).
+        G: Vector to condition data on the average activity level of the 
+            network. Should be 1 when avg > conditioning level and 
+            0 when avg < conditioning level.
+        k: Maximum time lag for the PDF to consider.
+        IFT: Whether to include in instant feedback term, that is, to 
+            condition on the present state of the sending variable
+            as well as its past.
+        state_dtype: Integer type used to store the pre-computed state 
+            indices, or 'auto' for the narrowest type that holds every 
+            state of the PDF. The scores do not depend on this choice.
+        verbose: Control what gets printed to the console.
+        
+    Returns:
+        P: Array, PDF for computing GTE(i -> j). Order of dimsensions is
+            (jnow, jpast, inow(if IFT), ipast, G, neuron i, neuron j).
+            Total number of dimensions will depend on k and IFT.
+    """
+    dims, mult, MD_list_1, MD_list_2, multGVector = _state_codes(
+        D, G, k=k, IFT=IFT, state_dtype=state_dtype)
+    neurons = dims[-1]
+    
+    minlength = np.prod(dims[:-2])
+    
+    # This will become the final PDF. Fortran order so that the state
+    # counts of each ij pair are contiguous and the reshape does not copy
+    P = np.zeros((minlength, neurons, neurons), order='F')
     
     if verbose > 0:
         print('Generating PDF for {} neurons'.format(neurons))
-        total_conns = int((neurons**2 - neurons)/2)
-        count = 0
-        bar = pb.ProgressBar(max_value=total_conns,
+        bar = pb.ProgressBar(max_value=neurons,
                              widgets=[pb.Percentage(),
                                       ' - ', pb.Bar(), 
                                       ' - ', pb.ETA()])
     
-    for i in range(neurons): 
-        for j in range(i+1, neurons):
-            
-            # Sum over multiplied jnow, jpast, ipast, G
-            indexIJ = MD_list_1[j] + MD_list_2[i] + multGVector
-            
-            # Displacement factor to access the ij neuron in the matrix
-            displace = i*multipliers[-2]+j*multipliers[-1]
-            
-            # Count the number of times that any given index comes up 
-            bincounts = np.bincount(
-                indexIJ.astype(np.int), minlength=minlength)
-            
-            # Apply the displacement and increment PDF values
-            index = Pnumel + displace
-            P[index.astype(np.int)] += bincounts
-            
-            # Repeat the above for the j --> i connection
-            indexJI = MD_list_1[i] + MD_list_2[j] + multGVector
-            displace = j*multipliers[-2] + i*multipliers[-1]
-            bincounts = np.bincount(
-                    indexJI.astype(np.int), minlength=minlength)
-            index = Pnumel + displace
-            P[index.astype(np.int)] += bincounts
+    for i in range(neurons):
+        
+        # Count the number of times that any given index comes up for
+        # all i --> j connections
+        P[:,i,:] = _sender_counts(
+            MD_list_1, MD_list_2, multGVector, i, minlength)
             
-            if verbose > 0:
-                bar.update(count)
-                count += 1
+        if verbose > 0:
+            bar.update(i+1)
     
     if verbose > 0:        
         bar.finish()
@@ -133,18 +224,126 @@ def calc_PDF(D, G, k=2, IFT=True, verbose=1):
     return P.reshape(dims, order='F')
 
 
+def calc_PDF_blocks(
+    D, G, k=2, IFT=True, block_size=100, state_dtype='auto', verbose=1):
+    """Generates the PDF for calculating GTE in blocks of sending neurons,
+    so that the full PDF never has to be held in memory. Counts are stored
+    as uint32, which is a quarter of the size of the float PDF.
+    
+    Args:
+        D: Neuron firing data in shape (timesteps, neurons). Data points
+            should be integer values; either spikes or discretized 
+            fluorescence data. Binary spikes may also be given as a 
+            utils.PackedSpikes object, shape (neurons, timesteps).
+        G: Vector to condition data on the average activity level of the 
+            network. Should be 1 when avg > conditioning level and 
+            0 when avg < conditioning level.
+        k: Maximum time lag for the PDF to consider.
+        IFT: Whether to include in instant feedback term, that is, to 
+            condition on the present state of the sending variable
+            as well as its past.
+        block_size: Number of sending neurons in each block.
+        state_dtype: Integer type used to store the pre-computed state 
+            indices, or 'auto' for the narrowest type that holds every 
+            state of the PDF. The scores do not depend on this choice.
+        verbose: Control what gets printed to the console.
+        
+    Yields:
+        rows: Slice of the sending neurons included in the block.
+        P: Array, unnormalized PDF for computing GTE(i -> j) with i 
+            restricted to the block. Order of dimensions is the same as 
+            in calc_PDF, with shape (block_size, neurons) for the 
+            last two dimensions.
+    """
+    dims, mult, MD_list_1, MD_list_2, multGVector = _state_codes(
+        D, G, k=k, IFT=IFT, state_dtype=state_dtype)
+    neurons = dims[-1]
+    minlength = np.prod(dims[:-2])
+    
+    if verbose > 0:
+        print('Generating PDF for {} neurons in blocks of {}'
+              .format(neurons, block_size))
+        bar = pb.ProgressBar(max_value=neurons,
+                             widgets=[pb.Percentage(),
+                                      ' - ', pb.Bar(), 
+                                      ' - ', pb.ETA()])
+    
+    for start in range(0, neurons, block_size):
+        
+        rows = slice(start, min(start + block_size, neurons))
+        block = np.arange(neurons)[rows]
+        
+        # Fortran order so that each ij count vector is contiguous and 
+        # the reshape below does not copy
+        P = np.zeros(
+            (minlength, block.size, neurons), dtype=np.uint32, order='F')
+        
+        for b, i in enumerate(block):
+            P[:,b,:] = _sender_counts(
+                MD_list_1, MD_list_2, multGVector, i, minlength)
+        
+        if verbose > 0:
+            bar.update(rows.stop)
+                
+        yield rows, P.reshape(
+            list(dims[:-2]) + [block.size, neurons], order='F')
+        
+    if verbose > 0:        
+        bar.finish()
+
+
+def _sum_GTE(P, k=2, IFT=True):
+    """Sums the GTE terms of an unnormalized PDF over all of its state
+    dimensions.
+    
+    Args:
+        P: Array, unnormalized float PDF whose first dimensions are
+            (jnow, jpast, inow(if IFT), ipast), followed by G and any 
+            number of other dimensions.
+        k: Maximum time lag used when generating the PDF.
+        IFT: Whether the instant feedback term was included when 
+            generating the PDF.
+            
+    Returns:
+        GTE: Array of unnormalized GTE scores, with the shape of the 
+            dimensions of P that follow the state dimensions.
+    """
+    ndims = 2*k + 1 + IFT
+    
+    # Partial sums
+    # P(j(k), i(k), g)
+    jk_ik_g = np.sum(P, axis=0, keepdims=True)
+    
+    # P(j, j(k), g)
+    index_j_jk_g = range(k+1, ndims)
+    j_jk_g = np.sum(P, axis=tuple(index_j_jk_g), keepdims=True)
+    
+    # P(j(k), g), which is just j_jk_g summed over jnow
+    jk_g = np.sum(j_jk_g, axis=0, keepdims=True)
+    
+    # Always complains about zero division
+    with np.errstate(divide='ignore', invalid='ignore'):
+        GTE = P*np.log2(P*jk_g/(j_jk_g*jk_ik_g))
+    GTE[np.isnan(GTE)] = 0
+        
+    # Sum over all state dimensions
+    return np.sum(GTE, axis=tuple(range(ndims)))
+
+
 def calc_GTE_from_PDF(P, IFT=True, verbose=1):
     """Calculates matrix of GTE scores from an unnormalized PDF.
     
     Args:
-        P: Array, unnormalized PDF. Shape as described in calc_PDF.
+        P: Array, unnormalized PDF. Shape as described in calc_PDF, or a
+            block of the PDF as generated by calc_PDF_blocks.
         IFT: Wheter the instant feedback term was included when 
             generating the PDF. The function will crash if this is
             incorrect.
         verbose: Control what gets printed to the console.
             
     Returns:
-        GTE: Array of GTE scores, shape (neurons, neurons)
+        GTE: Array of GTE scores, shape (neurons, neurons), or 
+            (block_size, neurons) if P is a block of the PDF.
     """
     if verbose > 0:
         print('Calculating GTE from PDF')
@@ -157,31 +356,212 @@ def calc_GTE_from_PDF(P, IFT=True, verbose=1):
     dim = (ndimsP-3) - IFT
     k = dim//2
     
-    # Partial sums
-    # P(j(k), i(k), g)
-    jk_ik_g = np.sum(P, axis=0, keepdims=True)
+    GTE = _sum_GTE(P, k=k, IFT=IFT)
+        
+    # Normalization factor is the sum of entries with average activity 
+    # below conditioning level. This is the same for every ij pair, but the
+    # diagonal is never filled, so we take the largest sum of P over all 
+    # other axes at G=0. This also works on a block of the PDF
+    normFactor = 1/np.max(np.sum(P, axis=(tuple(range(ndimsP-3))))[0])
     
-    # P(j, j(k), g)
-    index_j_jk_g = range(ndimsP)[k+1:-3]
-    j_jk_g = np.sum(P, axis=tuple(index_j_jk_g), keepdims=True)
+    return GTE[0,:,:]*normFactor
+
+
+def _fused_rows(MD_list_1, MD_list_2, multGVector, shape, k, IFT, rows):
+    """Calculates the unnormalized GTE scores of a block of sending 
+    neurons, reducing the PDF of each sending neuron as soon as it is 
+    generated.
     
-    # P(j(k), g), which is just j_jk_g summed over jnow
-    jk_g = np.sum(j_jk_g, axis=0, keepdims=True)
+    Args:
+        MD_list_1: Array of state indices for each neuron as reciever.
+        MD_list_2: Array of state indices for each neuron as sender.
+        multGVector: State indices of the conditioning vector.
+        shape: Dimensions of the PDF of a single ij pair.
+        k: Maximum time lag to consider.
+        IFT: Whether to include in instant feedback term.
+        rows: Range of sending neurons to calculate scores for.
+        
+    Returns:
+        rows: The range of sending neurons, as given.
+        GTE: Array of unnormalized GTE scores, shape (rows, neurons).
+    """
+    neurons = MD_list_1.shape[0]
+    minlength = np.prod(shape)
+    GTE = np.zeros((len(rows), neurons))
     
-    # Always complains about zero division
-    warnings.simplefilter('ignore')
-    GTE = P*np.log2(P*jk_g/(j_jk_g*jk_ik_g))
-    GTE[np.isnan(GTE)] = 0
+    for b, i in enumerate(rows):
         
-    # Sum over all dimensions except G, neuron i and neuron j
-    GTE = np.sum(GTE, axis=tuple(range(ndimsP-3)))
+        # PDF for all i --> j connections
+        P = _sender_counts(MD_list_1, MD_list_2, multGVector, i, minlength)
+        P = P.reshape(shape + [neurons], order='F').astype(np.float64)
+        GTE[b] = _sum_GTE(P, k=k, IFT=IFT)[0]
+            
+    return rows, GTE
+
+
+# Arrays shared with the worker processes of calc_GTE_fused
+_shared = dict()
+
+
+def _init_fused_worker(arrays, multGVector, shape, k, IFT):
+    """Attaches a worker process of calc_GTE_fused to the shared
+    state index arrays."""
+    for name, (shm_name, shape_, dtype) in arrays.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared[name + '_shm'] = shm
+        _shared[name] = np.ndarray(shape_, dtype=dtype, buffer=shm.buf)
         
-    # Normalization factor is the sum of entries with average activity 
-    # below conditioning level. We get this by choosing an arbitrary neuron
-    # (in this case i=1, j=2), G=0, and summing P over all other axes
-    normFactor = 1/np.sum(P, axis=(tuple(range(ndimsP-3))))[0,1,2]
+    _shared['args'] = (multGVector, shape, k, IFT)
+
+
+def _fused_worker(rows):
+    """Calculates a block of GTE scores in a worker process."""
+    return _fused_rows(
+        _shared['MD_list_1'], _shared['MD_list_2'], *_shared['args'], 
+        rows=rows)
+
+
+def iter_GTE_fused(
+    D, G, k=2, IFT=True, n_jobs=1, state_dtype='auto', block_size=None, 
+    verbose=1):
+    """Calculates GTE scores directly from data, one block of sending
+    neurons at a time. The PDF of each sending neuron is reduced to its 
+    GTE scores as soon as it is generated, and blocks of scores are 
+    yielded as soon as they are ready, so that callers can process them 
+    without keeping the full score matrix.
     
-    return GTE[0,:,:]*normFactor
+    Args:
+        D: Neuron firing data in shape (timesteps, neurons). Data points
+            should be integer values; either spikes or discretized 
+            fluorescence data. Binary spikes may also be given as a 
+            utils.PackedSpikes object, shape (neurons, timesteps).
+        G: Vector to condition data on the average activity level of the 
+            network. Should be 1 when avg > conditioning level and 
+            0 when avg < conditioning level.
+        k: Maximum time lag to consider.
+        IFT: Whether to include in instant feedback term, that is, to 
+            condition on the present state of the sending variable
+            as well as its past.
+        n_jobs: Number of worker processes. Blocks of sending neurons
+            are distributed over the workers, which read the pre-computed
+            state indices from shared memory. The scores are identical
+            to those computed with a single process.
+        state_dtype: Integer type used to store the pre-computed state 
+            indices, or 'auto' for the narrowest type that holds every 
+            state of the PDF. The scores do not depend on this choice.
+        block_size: Number of sending neurons in each yielded block. By
+            default there are a few blocks per worker.
+        verbose: Control what gets printed to the console.
+        
+    Yields:
+        rows: Range of the sending neurons included in the block. Blocks
+            may arrive in any order when n_jobs > 1.
+        GTE: Array of GTE scores, shape (rows, neurons).
+    """
+    dims, mult, MD_list_1, MD_list_2, multGVector = _state_codes(
+        D, G, k=k, IFT=IFT, state_dtype=state_dtype)
+    neurons = dims[-1]
+    shape = list(dims[:-2])
+    
+    # Normalization factor is the number of samples with average activity
+    # below conditioning level, which is the same for every ij pair
+    normFactor = 1/np.sum(multGVector == 0)
+    
+    # A few blocks per worker to keep them all busy until the end
+    if block_size is None:
+        block_size = max(1, -(-neurons//(4*n_jobs)))
+    blocks = [range(start, min(start + block_size, neurons)) 
+              for start in range(0, neurons, block_size)]
+    
+    if verbose > 0:
+        print('Calculating GTE for {} neurons'.format(neurons))
+        count = 0
+        bar = pb.ProgressBar(max_value=neurons,
+                             widgets=[pb.Percentage(),
+                                      ' - ', pb.Bar(), 
+                                      ' - ', pb.ETA()])
+        
+    if n_jobs > 1:
+        
+        shms = []
+        arrays = dict()
+        for name, array in zip(
+                ['MD_list_1', 'MD_list_2'], [MD_list_1, MD_list_2]):
+            shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            shms.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = \
+                array
+            arrays[name] = (shm.name, array.shape, array.dtype)
+            
+        try:
+            with Pool(n_jobs, initializer=_init_fused_worker, 
+                      initargs=(arrays, multGVector, shape, k, IFT)) as pool:
+                
+                for rows, block in pool.imap_unordered(_fused_worker, blocks):
+                    
+                    if verbose > 0:
+                        count += len(rows)
+                        bar.update(count)
+                        
+                    yield rows, block*normFactor
+                        
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+                
+    else:
+        
+        for rows in blocks:
+            _, block = _fused_rows(
+                MD_list_1, MD_list_2, multGVector, shape, k, IFT, rows)
+            
+            if verbose > 0:
+                count += len(rows)
+                bar.update(count)
+                
+            yield rows, block*normFactor
+    
+    if verbose > 0:        
+        bar.finish()
+
+
+def calc_GTE_fused(
+    D, G, k=2, IFT=True, n_jobs=1, state_dtype='auto', verbose=1):
+    """Calculates matrix of GTE scores directly from data. The PDF of each 
+    sending neuron is reduced to its GTE scores as soon as it is generated,
+    so only the score matrix is kept in memory.
+    
+    Args:
+        D: Neuron firing data in shape (timesteps, neurons). Data points
+            should be integer values; either spikes or discretized 
+            fluorescence data. Binary spikes may also be given as a 
+            utils.PackedSpikes object, shape (neurons, timesteps).
+        G: Vector to condition data on the average activity level of the 
+            network. Should be 1 when avg > conditioning level and 
+            0 when avg < conditioning level.
+        k: Maximum time lag to consider.
+        IFT: Whether to include in instant feedback term, that is, to 
+            condition on the present state of the sending variable
+            as well as its past.
+        n_jobs: Number of worker processes, see iter_GTE_fused.
+        state_dtype: Integer type used to store the pre-computed state 
+            indices, or 'auto' for the narrowest type that holds every 
+            state of the PDF. The scores do not depend on this choice.
+        verbose: Control what gets printed to the console.
+        
+    Returns:
+        GTE: Array of GTE scores, shape (neurons, neurons).
+    """
+    neurons = _data_shape(D)[1]
+    GTE = np.zeros((neurons, neurons))
+    
+    for rows, block in iter_GTE_fused(
+            D, G, k=k, IFT=IFT, n_jobs=n_jobs, state_dtype=state_dtype, 
+            verbose=verbose):
+        GTE[rows.start:rows.stop] = block
+        
+    return GTE
 
 
 def get_conditioning(D, CL=0.25, estimate_CL=False, verbose=1):
@@ -192,7 +572,8 @@ def get_conditioning(D, CL=0.25, estimate_CL=False, verbose=1):
     Args:
         D: Neuron firing data in shape (timesteps, neurons). Data points
             should be integer values; either spikes or discretized 
-            fluorescence data.
+            fluorescence data. Binary spikes may also be given as a 
+            utils.PackedSpikes object, shape (neurons, timesteps).
         CL: Conditioning level. 
         estimate_CL: Whether to estimate the conditioning level based on
             the histogram average activity.
@@ -201,7 +582,10 @@ def get_conditioning(D, CL=0.25, estimate_CL=False, verbose=1):
     Returns:
         G: Conditioning vector, 1 when avg >= CL, 0 when avg < CL.
     """
-    avg_D = np.mean(D, axis=1, dtype=np.float64)
+    if isinstance(D, PackedSpikes):
+        avg_D = D.sum(axis=0)/D.shape[0]
+    else:
+        avg_D = np.mean(D, axis=1, dtype=np.float64)
     
     if estimate_CL:
         if verbose > 0:
@@ -214,14 +598,17 @@ def get_conditioning(D, CL=0.25, estimate_CL=False, verbose=1):
     return np.greater_equal(avg_D, CL)
 
 
-def calc_GTE(D, CL=0.25, k=2, IFT=True, estimate_CL=False, verbose=1):
+def calc_GTE(
+    D, CL=0.25, k=2, IFT=True, estimate_CL=False, block_size=None, 
+    fused=False, n_jobs=1, state_dtype='auto', verbose=1):
     """Convenience function to go directly from data to a matrix
     of GTE scores.
     
     Args:
         D: Neuron firing data in shape (timesteps, neurons). Data points
             should be integer values; either spikes or discretized 
-            fluorescence data.
+            fluorescence data. Binary spikes may also be given as a 
+            utils.PackedSpikes object, shape (neurons, timesteps).
         CL: Conditioning level.
         k: Maximum time lag to consider.
         IFT: Whether to include in instant feedback term, that is, to 
@@ -229,13 +616,255 @@ def calc_GTE(D, CL=0.25, k=2, IFT=True, estimate_CL=False, verbose=1):
             as well as its past.
         estimate_CL: Whether to estimate the conditioning level based on
             the histogram of average activity.
+        block_size: If given, the PDF is generated and reduced in blocks 
+            of this many sending neurons instead of all at once, which
+            bounds memory use for large numbers of neurons.
+        fused: Whether to reduce the PDF of each sending neuron to GTE scores
+            as soon as it is generated, so that the full PDF is never kept.
+            Takes precedence over block_size.
+        n_jobs: Number of worker processes to use. Parallel execution
+            is only supported by the fused method, which will be used 
+            whenever n_jobs > 1.
+        state_dtype: Integer type used to store the pre-computed state 
+            indices, or 'auto' for the narrowest type that holds every 
+            state of the PDF. The scores do not depend on this choice.
         verbose: Control what gets printed to the console.
         
     Returns:
         scores: Adjacency matrix of GTE scores, shape (neurons, neurons).
     """
     G = get_conditioning(D, CL=CL, estimate_CL=estimate_CL, verbose=verbose)
-    P = calc_PDF(D, G, k=k, IFT=IFT, verbose=verbose)
-    scores = calc_GTE_from_PDF(P, IFT=IFT, verbose=verbose)
     
-    return scores
\ No newline at end of file
+    if fused or n_jobs > 1:
+        scores = calc_GTE_fused(
+            D, G, k=k, IFT=IFT, n_jobs=n_jobs, state_dtype=state_dtype, 
+            verbose=verbose)
+    
+    elif block_size is None:
+        P = calc_PDF(
+            D, G, k=k, IFT=IFT, state_dtype=state_dtype, verbose=verbose)
+        scores = calc_GTE_from_PDF(P, IFT=IFT, verbose=verbose)
+        
+    else:
+        neurons = _data_shape(D)[1]
+        scores = np.zeros((neurons, neurons))
+        for rows, P in calc_PDF_blocks(
+                D, G, k=k, IFT=IFT, block_size=block_size, 
+                state_dtype=state_dtype, verbose=verbose):
+            scores[rows] = calc_GTE_from_PDF(P, IFT=IFT, verbose=0)
+    
+    return scores
+
+
+def calc_GTE_sweep(
+    D, CL=[0.25], k=[2], IFT=[True, False], state_dtype='auto', verbose=1):
+    """Calculates matrices of GTE scores for several combinations of 
+    parameters with a single pass over the data. The PDF is generated once
+    for the largest k, with the instant feedback term and one conditioning 
+    level per CL value, and the PDF for every other combination is 
+    obtained by summing over the unused dimensions. 
+    
+    All combinations use the time samples that are valid for the largest
+    k, so scores for smaller k leave out the first few samples and can 
+    differ very slightly from those of calc_GTE.
+    
+    Args:
+        D: Neuron firing data in shape (timesteps, neurons). Data points
+            should be integer values; either spikes or discretized 
+            fluorescence data. Binary spikes may also be given as a 
+            utils.PackedSpikes object, shape (neurons, timesteps).
+        CL: List of conditioning levels.
+        k: List of maximum time lags.
+        IFT: List of settings for the instant feedback term.
+        state_dtype: Integer type used to store the pre-computed state 
+            indices, or 'auto' for the narrowest type that holds every 
+            state of the PDF.
+        verbose: Control what gets printed to the console.
+        
+    Returns:
+        scores: Dict of adjacency matrices of GTE scores, each of shape 
+            (neurons, neurons). Keys are (CL, k, IFT) tuples.
+    """
+    CL = np.sort(CL)
+    k_max = max(k)
+    
+    # Conditioning level of each sample is the number of CL values that 
+    # the average activity reaches, so that G = 0 for the c-th CL value 
+    # corresponds to levels 0 to c
+    if isinstance(D, PackedSpikes):
+        avg_D = D.sum(axis=0)/D.shape[0]
+    else:
+        avg_D = np.mean(D, axis=1, dtype=np.float64)
+    G = np.sum(np.greater_equal(avg_D[:,None], CL[None,:]), axis=1)
+    
+    dims, mult, MD_list_1, MD_list_2, multGVector = _state_codes(
+        D, G, k=k_max, IFT=True, levels=CL.size+1, state_dtype=state_dtype)
+    neurons = dims[-1]
+    minlength = np.prod(dims[:-2])
+    shape = list(dims[:-2]) + [neurons]
+    
+    # Normalization factors are the number of valid samples with average 
+    # activity below each conditioning level
+    normFactors = 1/np.cumsum(np.bincount(G[k_max:], minlength=CL.size+1))
+    
+    scores = dict()
+    for c in CL:
+        for k_ in k:
+            for IFT_ in IFT:
+                scores[(c, k_, IFT_)] = np.zeros((neurons, neurons))
+                
+    if verbose > 0:
+        print('Calculating GTE sweep of {} parameter sets for {} neurons'
+              .format(len(scores), neurons))
+        bar = pb.ProgressBar(max_value=neurons,
+                             widgets=[pb.Percentage(),
+                                      ' - ', pb.Bar(), 
+                                      ' - ', pb.ETA()])
+    
+    for i in range(neurons):
+        
+        # PDF for all i --> j connections, with dimensions (jnow, jpast, 
+        # inow, ipast, G, neuron j). Summing over G gives the PDF for 
+        # every CL value
+        P = _sender_counts(MD_list_1, MD_list_2, multGVector, i, minlength)
+        P = P.reshape(shape, order='F').astype(np.float64)
+        P = np.cumsum(P, axis=-2)
+        
+        for k_ in k:
+            
+            # Sum over the jpast and ipast lags beyond k
+            lags = tuple(range(k_+1, k_max+1)) + \
+                tuple(range(k_max+k_+2, 2*k_max+2))
+            P_k = np.sum(P, axis=lags)
+            
+            for IFT_ in IFT:
+                
+                # Sum over inow
+                P_ = P_k if IFT_ else np.sum(P_k, axis=k_+1)
+                GTE = _sum_GTE(P_, k=k_, IFT=IFT_)
+                
+                for c_idx, c in enumerate(CL):
+                    scores[(c, k_, IFT_)][i] = GTE[c_idx]*normFactors[c_idx]
+                
+        if verbose > 0:
+            bar.update(i+1)
+            
+    if verbose > 0:        
+        bar.finish()
+        
+    return scores
+
+
+class GTEAccumulator(object):
+    """Accumulates the PDF for calculating GTE over consecutive chunks of
+    data, so that GTE scores can be computed while a recording is still 
+    being read or acquired. Memory use depends on the chunk size and the 
+    number of neurons, but not on the length of the recording. The last k 
+    frames of each chunk are carried over to the next one, so the final 
+    scores are the same as those from calc_GTE on the full recording.
+    
+    Args:
+        neurons: Number of neurons in the recording.
+        CL: Conditioning level. Since the full recording is not available,
+            it can not be estimated.
+        k: Maximum time lag to consider.
+        IFT: Whether to include in instant feedback term, that is, to 
+            condition on the present state of the sending variable
+            as well as its past.
+        bins: Number of activity levels in the data, 2 for binary spikes.
+            Data points should be integers from 0 to bins - 1.
+    """
+    def __init__(self, neurons, CL=0.25, k=2, IFT=True, bins=2):
+        
+        self.neurons = neurons
+        self.CL = CL
+        self.k = k
+        self.IFT = IFT
+        self.bins = bins
+        
+        ndims = 2*k + 1 + IFT
+        dims = [bins for d in range(ndims)] + [2, neurons, neurons]
+        self.dims = np.array(dims)
+        self.minlength = np.prod(self.dims[:-2])
+        
+        # Fortran order so that the state counts of each ij pair are 
+        # contiguous, as in calc_PDF
+        self.counts = np.zeros(
+            (self.minlength, neurons, neurons), dtype=np.uint32, order='F')
+        
+        # Frames carried over from the previous chunk
+        self.last = np.zeros((0, neurons), dtype=np.int64)
+        self.timesteps = 0
+        
+    def update(self, chunk, verbose=1):
+        """Adds a chunk of data to the accumulated PDF.
+        
+        Args:
+            chunk: Neuron firing data in shape (timesteps, neurons), 
+                following on from the previous chunk.
+            verbose: Control what gets printed to the console.
+        """
+        chunk = np.asarray(chunk)
+        if chunk.shape[1] != self.neurons:
+            raise ValueError('Chunk has the wrong number of neurons')
+        if chunk.size and (chunk.min() < 0 or chunk.max() >= self.bins):
+            raise ValueError('Chunk values outside of the range of bins')
+        
+        D = np.concatenate((self.last, chunk.astype(np.int64)), axis=0)
+        self.timesteps += chunk.shape[0]
+        
+        # Not enough steps into the past yet
+        if D.shape[0] <= self.k:
+            self.last = D
+            return
+        
+        G = get_conditioning(D, CL=self.CL, verbose=0)
+        _, _, MD_list_1, MD_list_2, multGVector = _state_codes(
+            D, G, k=self.k, IFT=self.IFT, bins=self.bins, levels=2)
+        
+        if verbose > 0:
+            print('Accumulating PDF for {} timesteps'.format(chunk.shape[0]))
+            bar = pb.ProgressBar(max_value=self.neurons,
+                                 widgets=[pb.Percentage(),
+                                          ' - ', pb.Bar(), 
+                                          ' - ', pb.ETA()])
+        
+        for i in range(self.neurons):
+            
+            self.counts[:,i,:] += _sender_counts(
+                MD_list_1, MD_list_2, multGVector, i, self.minlength
+                ).astype(np.uint32)
+            
+            if verbose > 0:
+                bar.update(i+1)
+                
+        if verbose > 0:
+            bar.finish()
+        
+        self.last = D[D.shape[0]-self.k:]
+        
+    def scores(self, block_size=100, verbose=1):
+        """Calculates GTE scores from the data accumulated so far.
+        
+        Args:
+            block_size: Number of sending neurons to convert to GTE scores
+                at a time, which bounds the memory used in the conversion.
+            verbose: Control what gets printed to the console.
+        
+        Returns:
+            scores: Adjacency matrix of GTE scores, 
+                shape (neurons, neurons).
+        """
+        if verbose > 0:
+            print('Calculating GTE from {} accumulated timesteps'
+                  .format(self.timesteps))
+            
+        P = self.counts.reshape(self.dims, order='F')
+        scores = np.zeros((self.neurons, self.neurons))
+        
+        for start in range(0, self.neurons, block_size):
+            rows = slice(start, min(start + block_size, self.neurons))
+            scores[rows] = calc_GTE_from_PDF(
+                P[...,rows,:], IFT=self.IFT, verbose=0)
+            
+        return scores
@@ -12,6 +12,8 @@ Created on Wed Aug 23 14:24:32 2017
 import numpy as np
 import progressbar as pb
 
+from cnn.data_processing import assemble_examples, parent_means
+
 
 def predict_scores(model, ds_data, parents, mean, verbose=1, **params):
     """Uses a trained CNN model to predict class scores on
@@ -34,11 +36,36 @@ def predict_scores(model, ds_data, parents, mean, verbose=1, **params):
             Either 'jitter', 'block' or NoneType to skip shuffling.
         **num_blocks: Number of blocks to use if performing a 
             block shuffle.
+        **rng: np.random.Generator to draw the shuffles from. A new one
+            is created if not given.
+        **dtype: Data type of the batches fed to the model and of the 
+            scores. Keras models use float32, so other types are 
+            converted on every call. Scores are accumulated in at least 
+            float32 and cast to dtype on return.
+        **pairs_per_chunk: Number of neuron pairs to feed to the model at 
+            a time. Bounds the memory used for the batches.
+        **return_var: Whether to also return the variance of the scores
+            over the data slices.
+        **pairs: Boolean mask of shape (neurons, neurons) selecting the
+            (sending, recieving) pairs to predict, for example from 
+            data_processing.candidate_pairs. All pairs are predicted by 
+            default.
+        **fill_value: Score of the pairs that are not predicted, either a 
+            scalar or an array of scores for each class. Scores on the
+            diagonal are always zero.
+        **surrogates: Number of independent shuffles to predict at once.
+            The unshuffled channels are assembled once and shared by all
+            shuffles, and the examples of all shuffles are fed to the 
+            model together, pairs_per_chunk at a time.
     
     Returns:
         scores: Adjacency matrix of average scores for each class,
             shape (neurons, neurons, num_classes). Order of scores 
             along the class axis will be the same as the CNN output.
+            If surrogates is given, the scores of each shuffle are 
+            stacked along a new first axis.
+        var: Variance of the scores over the data slices, same shape as
+            scores. Only returned if return_var is True.
     """
     # Parameters
     num_classes = params.setdefault('num_classes', 3)
@@ -46,132 +73,288 @@ def predict_scores(model, ds_data, parents, mean, verbose=1, **params):
     batch_size = params.setdefault('batch_size', 256)
     shuffle_type = params.setdefault('shuffle_type', None)
     num_blocks = params.setdefault('num_blocks', 100)
+    rng = params.setdefault('rng', None)
+    dtype = params.setdefault('dtype', np.float32)
+    pairs_per_chunk = params.setdefault('pairs_per_chunk', 10000)
+    return_var = params.setdefault('return_var', False)
+    pairs = params.setdefault('pairs', None)
+    surrogates = params.setdefault('surrogates', None)
+    fill_value = params.setdefault('fill_value', 0)
     
     G = np.mean(ds_data, axis=0)
+    means = parent_means(ds_data, parents)
+    mean = mean.astype(dtype)
+    if rng is None and shuffle_type is not None:
+        rng = np.random.default_rng()
     
+    shuffles = 1 if surrogates is None else surrogates
     passes = ds_data.shape[1]//slice_len
+    # Sums over many passes lose precision in float16
     scores = np.zeros((
-        ds_data.shape[0], ds_data.shape[0], num_classes, passes))   
+        shuffles, ds_data.shape[0], ds_data.shape[0], num_classes), 
+        dtype=np.promote_types(dtype, np.float32))
+    if return_var:
+        M2 = np.zeros(scores.shape, dtype=scores.dtype)
     start_idx = np.arange(
         0, ds_data.shape[1]-slice_len, slice_len, dtype=np.int32)
     assert start_idx.size == passes
     
-    connections = int((ds_data.shape[0]**2 - ds_data.shape[0])/2)  
+    if pairs is None:
+        connections = ds_data.shape[0]**2 - ds_data.shape[0]
+    else:
+        connections = np.count_nonzero(pairs) - np.trace(pairs)
+    pairs_per_call = max(1, pairs_per_chunk//shuffles)
+    buffer = np.empty(shuffles*pairs_per_call*5*slice_len, dtype=dtype)
     
     if verbose > 0:
         print('Predicting scores')
 
     for n in range(passes):
-
-        batch = np.zeros((
-                ds_data.shape[0], ds_data.shape[0], 5, slice_len, 1))
         
         start = start_idx[n]
         end = start + slice_len
         
         if verbose > 0:
-            print('\nGenerating samples for batch {} of {}'
+            print('\nPredicting connectivity for batch {} of {}'
                   .format(n+1, passes))
             count = 0
             bar = pb.ProgressBar(max_value=connections,
                                  widgets=[pb.Percentage(),
                                           ' - ', pb.Bar(),
                                           ' - ', pb.ETA()])
-
-        for i in range(batch.shape[0]):
-            for j in range(i+1, batch.shape[0]):
-                
-                exI = ds_data[i][start:end]
-                exJ = ds_data[j][start:end]
-                exPI = np.mean(ds_data[parents[i], start:end], axis=0)
-                exPJ = np.mean(ds_data[parents[j], start:end], axis=0)
-                
-                # Shuffle potential drivers
-                if shuffle_type == None:
-                    exI_ = exI
-                    exJ_ = exJ
-                elif shuffle_type == 'jitter':
-                    exI_ = jitter_shuffle(exI)
-                    exJ_ = jitter_shuffle(exJ)
+        
+        for n1, n2 in pair_chunks(
+                ds_data.shape[0], pairs_per_call, mask=pairs):
+            
+            batch = buffer[:shuffles*n1.size*5*slice_len].reshape(
+                (shuffles, n1.size, 5, slice_len, 1))
+            assemble_examples(
+                ds_data, G, means, np.stack((n1, n2), axis=1), 
+                np.full(n1.size, start), batch[0])
+            batch[0] -= mean
+            batch[1:] = batch[0]
+            
+            # Shuffle potential drivers
+            if shuffle_type is not None:
+                drivers = np.broadcast_to(
+                    ds_data[n1, start:end], (shuffles, n1.size, slice_len))
+                if shuffle_type == 'jitter':
+                    batch[:,:,1,:,0] = jitter_shuffle(drivers, rng=rng)
                 elif shuffle_type == 'block':
-                    exI_ = block_shuffle(exI, num_blocks=num_blocks)
-                    exJ_ = block_shuffle(exJ, num_blocks=num_blocks)
-                
-                exG = G[start:end]
-
-                batch[i,j,:,:,0] = np.vstack((exPI, exI_, exG, exJ, exPJ)) 
-                batch[j,i,:,:,0] = np.vstack((exPJ, exJ_, exG, exI, exPI)) 
+                    batch[:,:,1,:,0] = block_shuffle(
+                        drivers, num_blocks=num_blocks, rng=rng)
+                else:
+                    raise ValueError('Invalid shuffle type')
+                batch[:,:,1] -= mean[1]
+            
+            pred = model.predict(
+                batch.reshape((-1, 5, slice_len, 1)), 
+                batch_size=batch_size, verbose=0)
+            pred = pred.reshape((shuffles, n1.size, num_classes))
+            
+            if return_var:
+                # Welford update, each pair gets one score per pass
+                delta = pred - scores[:, n1, n2]
+                scores[:, n1, n2] += delta/(n+1)
+                M2[:, n1, n2] += delta*(pred - scores[:, n1, n2])
+            else:
+                scores[:, n1, n2] += pred
+            
+            if verbose > 0:
+                count += n1.size
+                bar.update(count)
                 
-                if verbose > 0:
-                    bar.update(count)
-                    count += 1
-
         if verbose > 0:
             bar.finish()
-            print('\nPredicting connectivity for batch {} of {}'
-                  .format(n+1, passes))  
-            
-        pred = model.predict(batch.reshape((-1, 5, slice_len, 1)) - mean, 
-                             batch_size=batch_size, verbose=verbose > 0)
+
+    if pairs is not None:
+        skipped = ~pairs
+        np.fill_diagonal(skipped, False)
+        if return_var:
+            # Welford scores are already means
+            scores[:, skipped] = fill_value
+            M2[:, skipped] = 0
+        else:
+            scores[:, skipped] = np.asarray(fill_value)*passes
         
-        scores[:,:,:,n] = pred.reshape((ds_data.shape[0], 
-                                        ds_data.shape[0], 
-                                        num_classes))
+    if surrogates is None:
+        scores = scores[0]
+        if return_var:
+            M2 = M2[0]
         
-        # Ignore autocorrelation
-        for i in range(scores.shape[0]):
-            scores[i,i,:,n] = 0
+    if return_var:
+        return scores.astype(dtype), (M2/passes).astype(dtype)
+    
+    return (scores/passes).astype(dtype)
+
 
-    return np.mean(scores, axis=-1)
+def pair_chunks(neurons, pairs_per_chunk, mask=None):
+    """Iterates over ordered pairs of distinct neurons in chunks.
+    
+    Args:
+        neurons: Number of neurons.
+        pairs_per_chunk: Maximum number of pairs in each chunk.
+        mask: Boolean array of shape (neurons, neurons) selecting the 
+            pairs to iterate over. All pairs are used if not given.
+        
+    Yields:
+        n1: Array of sending neuron indices.
+        n2: Array of recieving neuron indices, in the same order as n1.
+    """
+    if mask is not None:
+        selected = np.flatnonzero(mask)
+        
+    for start in range(0, neurons**2, pairs_per_chunk):
+        if mask is None:
+            flat = np.arange(start, min(start + pairs_per_chunk, neurons**2))
+        else:
+            flat = selected[start:start + pairs_per_chunk]
+            if not flat.size:
+                break
+        n1, n2 = np.divmod(flat, neurons)
+        keep = n1 != n2
+        if keep.any():
+            yield n1[keep], n2[keep]
     
 
-def jitter_shuffle(vector):
-    """Performs a jitter shuffle on the input data."""
-    direction = np.random.choice([1,2,3], size=len(vector))
-    shuffled = np.copy(vector)
-    for i in range(1, len(vector)-1):
-        if direction[i] == 1:
-            shuffled[i-1] += vector[i]
-            shuffled[i] -= vector[i]
-        elif direction[i] == 3:
-            shuffled[i+1] += vector[i]
-            shuffled[i] -= vector[i]
+def jitter_shuffle(data, rng=None):
+    """Performs a jitter shuffle on the input data, moving the activity 
+    of each time frame to one of its neighbours or leaving it in place 
+    at random. 
+    
+    Args:
+        data: Array of time series to shuffle, along the last axis. 
+        rng: np.random.Generator to draw from. A new one is created if 
+            not given.
+            
+    Returns:
+        shuffled: Array of shuffled time series, same shape as data.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+        
+    direction = rng.integers(1, 4, size=data.shape)[...,1:-1]
+    moved = data[...,1:-1]
+    left = np.where(direction == 1, moved, 0)
+    right = np.where(direction == 3, moved, 0)
+    
+    shuffled = np.copy(data)
+    shuffled[...,1:-1] -= left + right
+    shuffled[...,:-2] += left
+    shuffled[...,2:] += right
             
     return shuffled 
 
-def block_shuffle(vector, num_blocks=100):
-    """Performs a blocks shuffle by splitting the input into 
-    randomly sized blocks, and then drawing randomly from these
-    blocks until a shuffled vector of sufficient length is 
-    generated.
+
+def block_shuffle(data, num_blocks=100, rng=None):
+    """Performs a block shuffle by splitting the input into randomly 
+    sized blocks, and then drawing randomly from these blocks until a 
+    shuffled time series of sufficient length is generated. Every block
+    is at least 1% of the length of the time series.
+    
+    Args:
+        data: Array of time series to shuffle, along the last axis. Each 
+            time series is split and shuffled independently.
+        num_blocks: Number of split points, giving num_blocks + 1 blocks.
+        rng: np.random.Generator to draw from. A new one is created if 
+            not given.
+            
+    Returns:
+        shuffled: Array of shuffled time series, same shape as data.
     """
-    count = 0
-    indices = np.random.randint(0, len(vector), size=num_blocks)
-    minlength = int(0.01*len(vector))
-    maxloops = 1000
-    
-    while (np.abs(np.diff(indices)) < minlength).any() and count < maxloops:
-        indices = np.random.randint(0, len(vector), size=num_blocks)
-        count += 1
+    if rng is None:
+        rng = np.random.default_rng()
         
-    if count == maxloops:
-        raise RuntimeError(
-            'Failed to generate enough blocks of minimum length')
+    length = data.shape[-1]
+    series = data.reshape((-1, length))
+    rows = np.arange(series.shape[0])[:,None]
+    minlength = max(1, int(0.01*length))
+    slack = length - (num_blocks + 1)*minlength
+    if slack < 0:
+        raise ValueError(
+            'Time series of length {} is too short for {} blocks'
+            .format(length, num_blocks + 1))
+    
+    # Split points at least minlength apart and away from the ends
+    splits = np.sort(rng.integers(
+        0, slack + 1, size=(series.shape[0], num_blocks)), axis=1)
+    splits += minlength*np.arange(1, num_blocks + 1)
+    starts = np.hstack((np.zeros_like(splits[:,:1]), splits))
+    lengths = np.diff(np.hstack((
+        starts, np.full_like(splits[:,:1], length))), axis=1)
+    
+    # Enough random blocks to cover the time series, then find the block
+    # and the offset within it for each shuffled time frame
+    draws = -(-length//minlength)
+    blocks = rng.integers(0, num_blocks + 1, size=(series.shape[0], draws))
+    ends = np.cumsum(lengths[rows, blocks], axis=1)
+    span = draws*length
+    pos = np.searchsorted(
+        (ends + rows*span).ravel(), 
+        (np.arange(length) + rows*span).ravel(), side='right')
+    pos = pos.reshape((-1, length)) - rows*draws
+    
+    block = blocks[rows, pos]
+    index = starts[rows, block] + np.arange(length) - (
+        ends[rows, pos] - lengths[rows, block])
+    
+    return series[rows, index].reshape(data.shape)
+
+
+def iter_null_scores(model, ds_data, parents, mean, verbose=1, **params):
+    """Iterates over the CNN predictions on surrogate shuffles of the data,
+    so that a null distribution can be processed one shuffle at a time.
+    
+    Args:
+        model: A trained keras Model object.
+        ds_data: Downsampled spike data, shape (neurons, timesteps).
+        parents: Dict of estimated parents for each neuron, 
+            keys and values should both be neuron indices.
+        mean: Mean of the training data, used for zero centering. Array of 
+            shape (5, slice_len, 1).
+        verbose: Control what gets printed to the console.
+        **num_shuffles: Number of shuffles to perform.
+        **shuffle_type: Shuffle method to use, either 'jitter' or 'block'.
+        **seed: Seed for the random shuffles.
+        **shuffles_per_call: Number of shuffles to predict together, see
+            the surrogates param of prediction.predict_scores.
+        
+        Also accepts **params for prediction.predict_scores.
+        
+    Yields:
+        null_scores: CNN predictions on one shuffle of the data, 
+            shape (neurons, neurons, num_classes).
+    """
+    # Parameters
+    num_shuffles = params.setdefault('num_shuffles', 500)
+    shuffle_type = params.setdefault('shuffle_type', 'jitter')
+    seed = params.setdefault('seed', None)
+    shuffles_per_call = params.setdefault('shuffles_per_call', 10)
+    params['return_var'] = False
+    params['rng'] = np.random.default_rng(seed)
+    
+    if verbose > 0:
+        print('Generating null distribution with {} {} shuffles'
+              .format(num_shuffles, shuffle_type))
+        bar = pb.ProgressBar(max_value=num_shuffles,
+                             widgets=[pb.Percentage(),
+                                      ' - ', pb.Bar(),
+                                      ' - ', pb.ETA()])
+    
+    for i in range(0, num_shuffles, shuffles_per_call):
+        
+        params['surrogates'] = min(shuffles_per_call, num_shuffles - i)
+        null_scores = predict_scores(
+            model, ds_data, parents, mean, verbose=0, **params)
         
-    blocks = np.split(np.arange(len(vector)), np.sort(indices))
-    count_ = 0
-    maxloops_ = len(vector)//minlength
-    indices_ = iter(np.random.randint(0, len(blocks), size=maxloops_))
-    
-    shuffled = []
-    while len(shuffled) < len(vector) and count_ < maxloops_:
-        shuffled.append(blocks[next(indices_)])
-        count += 1
+        for j in range(null_scores.shape[0]):
+            yield null_scores[j]
         
-    if count_ == maxloops_:
-        raise RuntimeError('Failed to generate a long enough sequence')
+            if verbose > 0:
+                bar.update(i+j+1)
         
-    return np.concatenate(shuffled)[:len(vector)]
+    if verbose > 0:
+        bar.finish()
 
 
 def get_null_dist(model, ds_data, parents, mean, verbose=1, **params):
@@ -189,6 +372,7 @@ def get_null_dist(model, ds_data, parents, mean, verbose=1, **params):
         **num_shuffles: Number of shuffles to perform.
         **shuffle_type: Shuffle method to use, either 'jitter' or 'block'.
         **num_classes: Number of prediction classes that the CNN outputs.
+        **dtype: Data type of the null distribution.
         
         Also accepts **params for prediction.predict_scores.
         
@@ -198,42 +382,27 @@ def get_null_dist(model, ds_data, parents, mean, verbose=1, **params):
     """
     # Parameters
     num_shuffles = params.setdefault('num_shuffles', 500)
-    shuffle_type = params.setdefault('shuffle_type', 'jitter')
     num_classes = params.setdefault('num_classes', 3)
+    dtype = params.setdefault('dtype', np.float32)
     
-    print(params)
-
     null_dist = np.zeros((
-        ds_data.shape[0], ds_data.shape[0], num_classes, num_shuffles))
+        ds_data.shape[0], ds_data.shape[0], num_classes, num_shuffles), 
+        dtype=dtype)
     
-    if verbose > 0:
-            print('Generating null distribution with {} {} shuffles'
-                  .format(num_shuffles, shuffle_type))
-            count = 0
-            bar = pb.ProgressBar(max_value=num_shuffles,
-                                 widgets=[pb.Percentage(),
-                                          ' - ', pb.Bar(),
-                                          ' - ', pb.ETA()])
-    
-    for i in range(num_shuffles):
-        
-        null_dist[:,:,:,i] = predict_scores(
-            model, ds_data, parents, mean, verbose=0, **params)
-        
-        bar.update(count)
-        count +=1
-        
-    bar.finish()
+    for i, null_scores in enumerate(iter_null_scores(
+            model, ds_data, parents, mean, verbose=verbose, **params)):
+        null_dist[:,:,:,i] = null_scores
         
     return null_dist
 
 
 def predict_network(
-    model, ds_data, parents, mean, scores=[], verbose=1, **params):
+    model, ds_data, parents, mean, scores=None, verbose=1, **params):
     """Predicts the adjacency matrix of a network using a trained CNN 
     model by comparing the predicted class scores with a null 
     distribution of scores from shuffled data, at significance level
-    alpha.
+    alpha. The null distribution is processed one shuffle at a time, 
+    and is only kept if requested.
     
     Args:
         model: A trained keras Model object.
@@ -251,6 +420,26 @@ def predict_network(
         **class_labels: List of integers that represent the output
             classes of the CNN. Will be used to fill the adjacency 
             matrix. Should be in the same order as CNN output.
+        **keep_null: What to keep of the null distribution. Either 
+            'full' for all surrogate scores, 'histogram' for a histogram
+            of the surrogate scores of each pair and class, or NoneType 
+            to discard them.
+        **null_bins: Number of equal width bins over [0, 1] if keeping
+            a histogram of the null distribution.
+        **early_stop: Whether to stop shuffling a pair once its p-values
+            are confidently above or below alpha for every class. Later
+            shuffles then only predict on the undecided pairs, and the 
+            p-values of a pair are computed from the shuffles it took 
+            part in.
+        **min_shuffles: Number of shuffles to perform on every pair 
+            before it can be stopped early.
+        **stop_z: z-score of the Wilson confidence interval used to 
+            decide if a p-value is above or below alpha.
+        **pairs: Boolean mask of shape (neurons, neurons) selecting the 
+            (sending, recieving) pairs to score and test, for example 
+            from data_processing.candidate_pairs. The other pairs are 
+            given fill_value as score, p-values of zero and no 
+            connection in the adjacency matrix.
         
         Also accepts **params for prediction.predict_scores and 
         prediction.get_null_dist.
@@ -259,18 +448,84 @@ def predict_network(
         adj_mat: Predicted adjacency matrix, shape (neurons, neurons).
         pvals: Array of calculated p-values, 
             shape (neurons, neurons, classes).
+        null_dist: Depending on keep_null, the null distribution of 
+            shape (neurons, neurons, classes, num_shuffles), the counts 
+            of its histogram of shape (neurons, neurons, classes, 
+            null_bins), or NoneType. Surrogate scores skipped by early
+            stopping are NaN in the full distribution, and are not 
+            counted in the histogram.
     """
     # Parameters
     alpha = params.setdefault('alpha', 0.95)
     class_labels = params.setdefault('class_labels', [-1,0,1])
+    num_shuffles = params.setdefault('num_shuffles', 500)
+    dtype = params.setdefault('dtype', np.float32)
+    keep_null = params.setdefault('keep_null', None)
+    null_bins = params.setdefault('null_bins', 20)
+    early_stop = params.setdefault('early_stop', False)
+    min_shuffles = params.setdefault('min_shuffles', 20)
+    stop_z = params.setdefault('stop_z', 2.576)
+    pairs = params.setdefault('pairs', None)
+    params['return_var'] = False
     
-    if scores == []:
+    if scores is None:
         scores = predict_scores(
             model, ds_data, parents, mean, verbose=verbose, **params)
-    scores = np.expand_dims(scores, axis=-1)
-    null_dist = get_null_dist(
+    
+    # Number of surrogate scores that each score is greater or equal to,
+    # and number of shuffles that each pair took part in
+    exceed = np.zeros(scores.shape, dtype=np.int32)
+    trials = np.zeros(scores.shape[:2], dtype=np.int32)
+    
+    # Pairs still being shuffled. Updated in place, since the null scores
+    # are predicted on the pairs active at the start of each shuffle.
+    if pairs is None:
+        active = np.ones(scores.shape[:2], dtype=bool)
+    else:
+        active = np.array(pairs, dtype=bool)
+    if early_stop or pairs is not None:
+        params['pairs'] = active
+    
+    if keep_null == 'full':
+        null_dist = np.full(
+            scores.shape + (num_shuffles,), np.nan, dtype=dtype)
+    elif keep_null == 'histogram':
+        null_dist = np.zeros(scores.shape + (null_bins,), dtype=np.int32)
+        hist = null_dist.reshape((-1, null_bins))
+        rows = np.arange(hist.shape[0])
+    elif keep_null is None:
+        null_dist = None
+    else:
+        raise ValueError('Unknown keep_null option: {}'.format(keep_null))
+    
+    null_iter = iter_null_scores(
         model, ds_data, parents, mean, verbose=verbose, **params)
-    pvals = np.mean(scores >= null_dist, axis=-1)
+    
+    for i, null_scores in enumerate(null_iter):
+        
+        exceed += np.logical_and(scores >= null_scores, active[:,:,None])
+        trials += active
+        
+        if keep_null == 'full':
+            null_dist[active,:,i] = null_scores[active]
+        elif keep_null == 'histogram':
+            bins = np.clip(
+                (null_scores*null_bins).astype(np.int32), 0, null_bins-1)
+            hist[rows, bins.ravel()] += np.repeat(
+                active.ravel(), scores.shape[-1])
+            
+        if early_stop and i+1 >= min_shuffles:
+            active &= ~_resolved(exceed, trials, alpha, stop_z)
+            if not active.any():
+                null_iter.close()
+                if verbose > 0:
+                    print('\nAll pairs resolved after {} shuffles'
+                          .format(i+1))
+                break
+            
+    with np.errstate(invalid='ignore'):
+        pvals = exceed/trials[:,:,None]
+    pvals[trials == 0] = 0
     
     adj_mat = np.zeros((ds_data.shape[0], ds_data.shape[0]))
     for i, class_ in enumerate(class_labels):
@@ -279,3 +534,20 @@ def predict_network(
         adj_mat[mask] = class_
         
     return adj_mat, pvals, null_dist
+
+
+def _resolved(exceed, trials, alpha, z):
+    """Finds the pairs whose p-values are above or below alpha for every
+    class, according to a Wilson score interval."""
+    trials = trials[:,:,None]
+    
+    # Pairs outside the mask of predict_network have no trials, and are 
+    # never resolved
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = exceed/trials
+        denom = 1 + z**2/trials
+        center = (p + z**2/(2*trials))/denom
+        half = z*np.sqrt(p*(1 - p)/trials + z**2/(4*trials**2))/denom
+    
+    return np.logical_or(
+        center - half > alpha, center + half <= alpha).all(axis=-1)
@@ -7,7 +7,12 @@ Created on Mon Aug 28 11:21:43 2017
 
 @author: paul.herringer
 """
+import os
+
+import numpy as np
+
 from keras.models import load_model
+from keras.utils import Sequence
 from keras.callbacks import (
     EarlyStopping, 
     CSVLogger, 
@@ -15,7 +20,57 @@ from keras.callbacks import (
     TensorBoard,
     ReduceLROnPlateau
     )
-from cnn.data_processing import generate_dataset
+from cnn.data_processing import (
+    generate_dataset, 
+    generate_index, 
+    assemble_batch,
+    generate_store,
+    load_store,
+    store_manifest
+    )
+
+
+class ExampleSequence(Sequence):
+    """Keras Sequence that assembles batches of examples on demand from 
+    downsampled datasets, instead of holding every example in memory.
+    
+    Args:
+        sources: List of (ds_data, G, means) tuples for each dataset, as 
+            returned by data_processing.generate_index.
+        index: Array of example locations, shape (examples, 4), as 
+            returned by data_processing.generate_index.
+        labels: Array of labels, shape (examples, # of classes).
+        mean: Mean of the training examples, which is subtracted from 
+            every batch. Batches have the same data type as the mean.
+        batch_size: Number of examples in each batch.
+        shuffle: Whether to shuffle the examples after each epoch.
+    """
+    def __init__(
+        self, sources, index, labels, mean, batch_size=256, shuffle=True):
+        
+        self.sources = sources
+        self.index = index
+        self.labels = labels
+        self.mean = mean
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = np.arange(index.shape[0])
+        
+    def __len__(self):
+        return int(np.ceil(self.index.shape[0]/self.batch_size))
+    
+    def __getitem__(self, idx):
+        
+        rows = self.order[idx*self.batch_size:(idx+1)*self.batch_size]
+        batch = np.zeros((rows.size,) + self.mean.shape, dtype=self.mean.dtype)
+        assemble_batch(self.sources, self.index[rows], batch)
+        batch -= self.mean
+        
+        return batch, self.labels[rows]
+    
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.order = np.random.permutation(self.index.shape[0])
 
 
 def train_cnn_model(model, datasets, networks, parents, verbose=1, **params):
@@ -46,8 +101,20 @@ def train_cnn_model(model, datasets, networks, parents, verbose=1, **params):
         **lr_decay_factor: Factor to decay learning rate when loss plateaus.
             New lr = lr*factor.
         **lr_decay_patience: Patience of learning rate decay monitor.
+        **lazy: Whether to assemble training examples on demand for each
+            batch instead of generating the whole training set up front.
+            Memory use is then proportional to the size of the datasets
+            rather than the number of examples.
+        **store_dir: Directory of a training set stored on disk by 
+            data_processing.generate_store. If the stored set was made 
+            from the same data, params and seed it is memory mapped and 
+            used for training, otherwise it is generated and stored 
+            first. Not used in lazy mode.
+        **seed: Seed for the numpy random number generator used when
+            generating a stored training set.
         
-        Also accepts **params for data_processing.generate_dataset.
+        Also accepts **params for data_processing.generate_dataset, or
+        data_processing.generate_index in lazy mode.
         
     Returns:
         model: The Keras Model that obtained the best validation results
@@ -68,10 +135,42 @@ def train_cnn_model(model, datasets, networks, parents, verbose=1, **params):
     lr_decay_monitor = params.setdefault('lr_decay_monitor', 'val_loss')
     lr_decay_factor = params.setdefault('lr_decay_factor', 0.1)
     lr_decay_patience = params.setdefault('lr_decay_patience', 10)
+    lazy = params.setdefault('lazy', False)
+    
+    # Only used for the stored training set, and passed on explicitly
+    store_dir = params.pop('store_dir', None)
+    seed = params.pop('seed', None)
     
     # Training data
-    ex_train, ex_valid, lbl_train, lbl_valid, mean = generate_dataset(
-        datasets, networks, parents, mode='train', verbose=verbose, **params)
+    if lazy:
+        sources, idx_train, idx_valid, lbl_train, lbl_valid, mean = \
+            generate_index(datasets, networks, parents, mode='train', 
+                           verbose=verbose, **params)
+        
+    elif store_dir is not None:
+        
+        manifest = store_manifest(
+            datasets, networks, parents, seed=seed, **params)
+        
+        stored = None
+        if os.path.exists(os.path.join(store_dir, 'manifest.json')):
+            stored = load_store(store_dir)
+            if stored[-1] != manifest:
+                stored = None
+            elif verbose > 0:
+                print('Loading stored training set from', store_dir)
+                
+        if stored is None:
+            stored = generate_store(
+                store_dir, datasets, networks, parents, seed=seed, 
+                verbose=verbose, **params)
+            
+        ex_train, ex_valid, lbl_train, lbl_valid, mean, _ = stored
+        
+    else:
+        ex_train, ex_valid, lbl_train, lbl_valid, mean = generate_dataset(
+            datasets, networks, parents, mode='train', verbose=verbose, 
+            **params)
     
     # Callbacks
     early_stopper = EarlyStopping(monitor=early_stopping_monitor, 
@@ -87,19 +186,35 @@ def train_cnn_model(model, datasets, networks, parents, verbose=1, **params):
                                  patience=lr_decay_patience,
                                  verbose=1)
     
+    callbacks = [
+        early_stopper, 
+        csv_logger, 
+        checkpoint, 
+        tensorboard,
+        lr_decay
+        ]
+    
     # Training
     for b in batch_sizes:
-        model.fit(
-            ex_train, lbl_train, batch_size=b, epochs=epochs,
-            validation_data=(ex_valid, lbl_valid), shuffle=True,
-            callbacks=[
-                early_stopper, 
-                csv_logger, 
-                checkpoint, 
-                tensorboard,
-                lr_decay
-                ]
-            )
+        
+        if lazy:
+            train_seq = ExampleSequence(
+                sources, idx_train, lbl_train, mean, batch_size=b)
+            valid_seq = ExampleSequence(
+                sources, idx_valid, lbl_valid, mean, batch_size=b, 
+                shuffle=False)
+            model.fit_generator(
+                train_seq, steps_per_epoch=len(train_seq), epochs=epochs,
+                validation_data=valid_seq, validation_steps=len(valid_seq),
+                callbacks=callbacks
+                )
+            
+        else:
+            model.fit(
+                ex_train, lbl_train, batch_size=b, epochs=epochs,
+                validation_data=(ex_valid, lbl_valid), shuffle=True,
+                callbacks=callbacks
+                )
     
     model = load_model(logdir + 'best_model.h5')
     
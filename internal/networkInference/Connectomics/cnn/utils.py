@@ -8,10 +8,137 @@ Created on Thu Aug 24 15:48:48 2017
 
 @author: paul.herringer
 """
+import hashlib
+import os
+from itertools import islice
+
 import numpy as np
+import scipy.sparse as sp
+
+# Bump to invalidate spike caches written by older versions of this module
+_cache_version = 1
+
+
+class PackedSpikes(object):
+    """Binary spike data stored as bits along the time axis, which uses 8 
+    times less memory than a boolean array and 32 times less than the 
+    int32 arrays from read_spike_trains. Can be used in place of binary 
+    spike data in gte and data_processing.
+    
+    Args:
+        bits: Array of packed spikes as generated by np.packbits, 
+            shape (neurons, ceil(timesteps/8)).
+        timesteps: Number of time steps in the data.
+    """
+    def __init__(self, bits, timesteps):
+        
+        self.bits = bits
+        self.timesteps = timesteps
+        
+    @classmethod
+    def from_dense(cls, S):
+        """Packs spike data, shape (neurons, timesteps). Any number of 
+        spikes in a time bin is encoded as 1."""
+        return cls(np.packbits(np.greater(S, 0), axis=1), S.shape[1])
+    
+    @classmethod
+    def from_sparse(cls, S):
+        """Packs a scipy sparse matrix of spike data, shape (neurons, 
+        timesteps), without densifying it. Any number of spikes in a 
+        time bin is encoded as 1."""
+        S = sp.csr_matrix(S)
+        S.sum_duplicates()
+        S.eliminate_zeros()
+        
+        nbytes = -(-S.shape[1]//8)
+        rows = np.repeat(np.arange(S.shape[0]), np.diff(S.indptr))
+        
+        # Distinct bits of the same byte add up to their bitwise or
+        byte = rows*nbytes + S.indices//8
+        bit = np.left_shift(1, 7 - S.indices%8)
+        starts = np.flatnonzero(np.diff(byte, prepend=-1))
+        
+        bits = np.zeros((S.shape[0], nbytes), dtype=np.uint8)
+        if starts.size:
+            bits.ravel()[byte[starts]] = np.add.reduceat(bit, starts)
+        
+        return cls(bits, S.shape[1])
+    
+    @property
+    def shape(self):
+        return (self.bits.shape[0], self.timesteps)
+    
+    def unpack(self, neurons=slice(None)):
+        """Unpacks the spikes of one or more neurons into an array of 0 and
+        1 values of type uint8."""
+        return np.unpackbits(
+            self.bits[neurons], axis=-1)[...,:self.timesteps]
+    
+    def to_dense(self, frames=None, dtype=np.int32):
+        """Unpacks the spike data into an array of the given type, shape 
+        (neurons, timesteps). If frames is given, only those time frames
+        are unpacked."""
+        if frames is None:
+            frames = slice(None)
+            
+        S = np.zeros(
+            (self.shape[0], np.arange(self.timesteps)[frames].size), 
+            dtype=dtype)
+        step = self._step()
+        for start in range(0, self.shape[0], step):
+            rows = slice(start, start + step)
+            S[rows] = self.unpack(rows)[:,frames]
+            
+        return S
+    
+    def sum(self, axis=0):
+        """Counts spikes over all neurons (axis=0) or over all time
+        steps (axis=1)."""
+        if axis == 1:
+            return np.array([np.sum(self.unpack(i), dtype=np.int64) 
+                             for i in range(self.shape[0])])
+        elif axis != 0:
+            raise ValueError('Invalid axis')
+        
+        total = np.zeros(self.timesteps, dtype=np.int64)
+        step = self._step()
+        for start in range(0, self.shape[0], step):
+            rows = slice(start, start + step)
+            total += np.sum(self.unpack(rows), axis=0, dtype=np.int64)
+        
+        return total
+    
+    def lagged_codes(self, i, k, first_lag=0, shift=0):
+        """Encodes the present and past states of a single neuron into 
+        integers using bit operations. Bit shift + l - first_lag of the 
+        code at time t holds the state at time t - l, for l from 
+        first_lag to k.
+        
+        Args:
+            i: Index of the neuron.
+            k: Maximum time lag to encode.
+            first_lag: Smallest time lag to encode.
+            shift: Bit position of the state at the smallest time lag.
+            
+        Returns:
+            codes: Array of integer codes for time steps k to the end.
+        """
+        Si = self.unpack(i).astype(np.int64)
+        codes = np.zeros(self.timesteps - k, dtype=np.int64)
+        for l in range(first_lag, k+1):
+            codes |= Si[k-l:self.timesteps-l] << (shift + l - first_lag)
+            
+        return codes
+    
+    def _step(self):
+        """Number of neurons to unpack at a time, so that the unpacked
+        arrays stay small."""
+        return max(1, int(1e7)//max(1, self.timesteps))
 
 
-def read_spike_trains(files, timebin=20, data_type='sim', binning='no limit'):
+def read_spike_trains(
+    files, timebin=20, data_type='sim', binning='no limit', packed=False,
+    chunk_size=None, cache_dir=None, sparse=False):
     """Reads spike train data from file. Currently supports two file formats:
         
         1. Two one-column files, one with firing times in ms, the 
@@ -34,72 +161,270 @@ def read_spike_trains(files, timebin=20, data_type='sim', binning='no limit'):
         timebin: Width of temporal binning, in ms.
         data_type: 'sim' for the two file method, 'real' for one file.
         binning: Type of spike binning, either 'binary' or 'no limit'.
+        packed: Whether to return binary spike data packed into bits.
+            Only valid with binary binning.
+        chunk_size: If given, the files are read and binned this many 
+            spikes at a time, so that only the binned spike data needs 
+            to fit in memory.
+        cache_dir: If given, the parsed spikes and the binned spike data
+            are cached in this directory, keyed by a hash of the file 
+            contents and the binning params. Later calls load them with 
+            a copy-on-write memory map instead of parsing the files.
+        sparse: Whether to return the spike data as a scipy.sparse CSR 
+            matrix. The dense spike data is never built.
         
     Returns:
-        spikes: Array of spike data, shape (neurons, timesteps)
+        spikes: Array of spike data, shape (neurons, timesteps), or a
+            PackedSpikes object if packed is True, or a sparse matrix if
+            sparse is True.
     """
-    if data_type == 'sim':
+    if packed and binning != 'binary':
+        raise ValueError('Packed spikes require binary binning')
+    if packed and sparse:
+        raise ValueError('Spikes can not be both packed and sparse')
+    if binning not in ['binary', 'no limit']:
+        raise ValueError('Invalid binning type')
         
+    if data_type == 'sim':
         assert len(files) == 2
-        timefile = files[0]
-        indexfile = files[1]
+    elif data_type == 'real':
+        assert len(files) == 1
+        timebin /= 1000
+    else:
+        raise ValueError('Invalid data type')
+        
+    if cache_dir is not None:
+        source = _source_key(files, data_type)
+        binned_file = os.path.join(cache_dir, 'binned_{}.{}'.format(
+            hashlib.sha1(str((source, float(timebin), binning)).encode())
+            .hexdigest(), 'npz' if sparse else 'npy'))
+        
+        if os.path.exists(binned_file):
+            if sparse:
+                return sp.load_npz(binned_file)
+            spikes = np.load(binned_file, mmap_mode='c')
+            if packed:
+                return PackedSpikes.from_dense(spikes)
+            return spikes
+        
+        spike_iter = _cached_spikes(
+            files, data_type, chunk_size, cache_dir, source)
+    else:
+        spike_iter = _iter_spikes(files, data_type, chunk_size)
+        
+    if sparse:
+        spikes = _bin_sparse(spike_iter, timebin, data_type, binning)
+        if cache_dir is not None:
+            _save_atomic(binned_file, spikes)
+        return spikes
+    
+    spikes = np.zeros((0, 0), dtype=np.int32)
+    neurons = 0
+    timesteps = 0
+    
+    # Sorted neuron ids of real data, rows of spikes are in this order
+    unq = np.zeros(0, dtype=np.int64)
+    
+    for times, indices in spike_iter:
+        
+        time = _time_bins(times, timebin, data_type)
         
-        times = np.genfromtxt(timefile).astype(np.int32)
-        indices = np.genfromtxt(indexfile).astype(np.int32)
-        assert len(times) == len(indices)      
+        if data_type == 'sim':
+            index = indices.astype(np.int64)
+            
+        else:
+            ids, inverse = np.unique(
+                indices.astype(np.int64), return_inverse=True)
+            
+            # Insert the rows of new neurons in sorted order
+            unq_ = np.union1d(unq, ids)
+            if unq_.size > unq.size:
+                spikes_ = np.zeros(
+                    (unq_.size, spikes.shape[1]), dtype=np.int32)
+                spikes_[np.searchsorted(unq_, unq)] = spikes
+                spikes = spikes_
+                unq = unq_
+            index = np.searchsorted(unq, ids)[inverse]
         
-        spikes = np.zeros(
-            (np.max(indices)+1, np.max(times)//timebin+1), dtype=np.int32)
+        if not time.size:
+            continue
+        if data_type == 'sim':
+            neurons = max(neurons, int(np.max(index)) + 1)
+        else:
+            neurons = unq.size
+        timesteps = max(timesteps, int(np.max(time)) + 1)
         
+        # Grow by doubling, so that the spikes are rarely copied. Rows of
+        # real data already match the neuron ids.
+        if neurons > spikes.shape[0] or timesteps > spikes.shape[1]:
+            if data_type == 'real':
+                rows = neurons
+            else:
+                rows = max(neurons, 2*spikes.shape[0])
+            spikes_ = np.zeros(
+                (rows, max(timesteps, 2*spikes.shape[1])), dtype=np.int32)
+            spikes_[:spikes.shape[0], :spikes.shape[1]] = spikes
+            spikes = spikes_
+            
         if binning == 'binary':
-            for i in range(len(times)):
-                time = times[i]//timebin
-                index = indices[i]
-                spikes[index][time] = 1
-            
-        elif binning == 'no limit':
-            for i in range(len(times)):
-                time = times[i]//timebin
-                index = indices[i]
-                spikes[index][time] += 1
-                
+            spikes[index, time] = 1
         else:
-            raise ValueError('Invalid binning type')
+            flat, counts = np.unique(
+                np.ravel_multi_index((index, time), spikes.shape), 
+                return_counts=True)
+            spikes.ravel()[flat] += counts.astype(np.int32)
+    
+    spikes = np.ascontiguousarray(spikes[:neurons, :timesteps])
+    
+    if cache_dir is not None:
+        _save_atomic(binned_file, spikes)
             
-    elif data_type == 'real':
+    if packed:
+        return PackedSpikes.from_dense(spikes)
+            
+    return spikes
+
+
+def _time_bins(times, timebin, data_type):
+    """Finds the time bins of spikes read by read_spike_trains. Times of
+    simulated data are truncated to whole ms first."""
+    if data_type == 'sim':
+        times = times.astype(np.int64)
         
-        timebin /= 1000
+    return (times//timebin).astype(np.int64)
+
+
+def _bin_sparse(spike_iter, timebin, data_type, binning):
+    """Bins the spikes of read_spike_trains into a sparse CSR matrix,
+    keeping only the counts of distinct (neuron, time bin) pairs of each
+    chunk of spikes."""
+    keys = []
+    counts = []
+    
+    for times, indices in spike_iter:
+        # Neuron index or id in the high bits, time bin in the low bits
+        key = (indices.astype(np.int64) << 32) + _time_bins(
+            times, timebin, data_type)
+        key, count = np.unique(key, return_counts=True)
+        keys.append(key)
+        counts.append(count.astype(np.int32))
         
-        assert len(files) == 1
-        data = np.genfromtxt(files[0], skip_header=1, delimiter=',')
-        times = data[:,1]
-        indices = data[:,0].astype(np.int32)
-        assert len(times) == len(indices)
+    keys = np.concatenate(keys)
+    counts = np.concatenate(counts)
+    ids = keys >> 32
+    time = keys & 0xffffffff
+    
+    if data_type == 'sim':
+        index = ids
+        neurons = int(np.max(ids)) + 1 if ids.size else 0
+    else:
+        unq, index = np.unique(ids, return_inverse=True)
+        neurons = unq.size
+    timesteps = int(np.max(time)) + 1 if time.size else 0
         
-        unq = np.unique(indices)
-        idx = np.arange(unq.size)
-        spikes = np.zeros(
-            (unq.size, int(np.max(times)//timebin)+1), dtype=np.int32)
+    spikes = sp.csr_matrix(
+        (counts, (index, time)), shape=(neurons, timesteps))
+    spikes.sum_duplicates()
+    if binning == 'binary':
+        spikes.data[:] = 1
         
-        if binning == 'binary':
-            for i in range(len(times)):
-                time = int(times[i]//timebin)
-                index = int(idx[np.argwhere(unq==indices[i])])
-                spikes[index][time] = 1
-            
-        elif binning == 'no limit':
-            for i in range(len(times)):
-                time = int(times[i]//timebin)
-                index = int(idx[np.argwhere(unq==indices[i])])
-                spikes[index][time] += 1
-                
+    return spikes
+
+
+def _iter_spikes(files, data_type, chunk_size=None):
+    """Iterates over the spike times and neuron indices in the files of 
+    read_spike_trains, chunk_size spikes at a time, or all at once if
+    chunk_size is not given."""
+    if chunk_size is None:
+        if data_type == 'sim':
+            times = np.loadtxt(files[0], ndmin=1)
+            indices = np.loadtxt(files[1], ndmin=1)
+            assert len(times) == len(indices)
+            yield times, indices
         else:
-            raise ValueError('Invalid binning type')
-            
+            data = np.loadtxt(files[0], skiprows=1, delimiter=',', ndmin=2)
+            yield data[:,1], data[:,0]
+        return
+    
+    if data_type == 'sim':
+        with open(files[0], 'r') as timefile, \
+                open(files[1], 'r') as indexfile:
+            while True:
+                times = list(islice(timefile, chunk_size))
+                indices = list(islice(indexfile, chunk_size))
+                assert len(times) == len(indices)
+                if not times:
+                    break
+                yield (np.loadtxt(times, ndmin=1), 
+                       np.loadtxt(indices, ndmin=1))
+                
     else:
-            raise ValueError('Invalid data type')
+        with open(files[0], 'r') as datafile:
+            next(datafile)
+            while True:
+                lines = list(islice(datafile, chunk_size))
+                if not lines:
+                    break
+                data = np.loadtxt(lines, delimiter=',', ndmin=2)
+                yield data[:,1], data[:,0]
+
+
+def _source_key(files, data_type):
+    """Hashes the contents of spike files, so that cached spikes are 
+    invalidated when the files change."""
+    key = hashlib.sha1(str((_cache_version, data_type)).encode())
+    for filename in files:
+        with open(filename, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                key.update(block)
+                
+    return key.hexdigest()
+
+
+def _cached_spikes(files, data_type, chunk_size, cache_dir, source):
+    """Iterates over spike times and neuron indices like _iter_spikes, 
+    reading them from the cache if the files have been parsed before, 
+    and adding them to the cache otherwise."""
+    names = [os.path.join(cache_dir, 'spikes_{}_{}.bin'.format(source, name))
+             for name in ['times', 'indices']]
+    dtypes = [np.float64, np.int64]
+    
+    if all(os.path.exists(name) for name in names):
+        arrays = [np.fromfile(name, dtype=dtype) if not os.path.getsize(name)
+                  else np.memmap(name, dtype=dtype, mode='r') 
+                  for name, dtype in zip(names, dtypes)]
+        step = chunk_size or max(1, arrays[0].size)
+        for start in range(0, arrays[0].size, step):
+            yield arrays[0][start:start+step], arrays[1][start:start+step]
+        return
+    
+    # Parsed spikes are appended to temporary files, which only replace 
+    # the cached files once all spikes have been read
+    os.makedirs(cache_dir, exist_ok=True)
+    outfiles = [open(name + '.tmp', 'wb') for name in names]
+    try:
+        for times, indices in _iter_spikes(files, data_type, chunk_size):
+            for outf, array, dtype in zip(outfiles, [times, indices], dtypes):
+                array.astype(dtype).tofile(outf)
+            yield times, indices
+    finally:
+        for outf in outfiles:
+            outf.close()
             
-    return spikes
+    for name in names:
+        os.replace(name + '.tmp', name)
+        
+
+def _save_atomic(filename, array):
+    """Saves an array to a .npy file, or a sparse matrix to a .npz file,
+    that only appears once complete."""
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename + '.tmp', 'wb') as outf:
+        if sp.issparse(array):
+            sp.save_npz(outf, array, compressed=False)
+        else:
+            np.save(outf, array)
+    os.replace(filename + '.tmp', filename)
 
 
 def iter_loadtxt(filename, delimiter=',', skiprows=0, dtype=float):
@@ -23,6 +23,7 @@ gte_params = {
 
 # Training data files
 data_path = '/home/paul.herringer/Documents/normal-spike-trains/'
+cache_path = data_path + 'cache/'
 
 times_normal1 = data_path + 'normal-1-inh_off-times.txt'
 idx_normal1 = data_path + 'normal-1-inh_off-idx.txt'
@@ -37,7 +38,8 @@ idx_normal3 = data_path + 'normal-3-inh_off-idx.txt'
 network_normal3 = data_path + 'network_normal-3.txt'
 
 # Read in spike data and true networks, estimate parents and save
-spikes_normal1 = read_spike_trains([times_normal1, idx_normal1], timebin=30)
+spikes_normal1 = read_spike_trains(
+    [times_normal1, idx_normal1], timebin=30, cache_dir=cache_path)
 parents_normal1, scores_normal1 = estimate_parents(
     spikes_normal1, **gte_params)
 
@@ -48,7 +50,8 @@ with open(data_path + 'gte_scores_normal1_30ms_inh-off.pkl', 'wb') as outf:
     pickle.dump(scores_normal1, outf)
 
 
-spikes_normal2 = read_spike_trains([times_normal2, idx_normal2], timebin=30)
+spikes_normal2 = read_spike_trains(
+    [times_normal2, idx_normal2], timebin=30, cache_dir=cache_path)
 parents_normal2, scores_normal2 = estimate_parents(
     spikes_normal2, **gte_params)
 
@@ -59,7 +62,8 @@ with open(data_path + 'gte_scores_normal2_30ms_inh-off.pkl', 'wb') as outf:
     pickle.dump(scores_normal2, outf)
     
     
-spikes_normal3 = read_spike_trains([times_normal3, idx_normal3], timebin=30)
+spikes_normal3 = read_spike_trains(
+    [times_normal3, idx_normal3], timebin=30, cache_dir=cache_path)
 parents_normal3, scores_normal3 = estimate_parents(
     spikes_normal3, **gte_params)
 
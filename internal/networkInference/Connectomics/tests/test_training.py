@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that train_cnn_model generates a stored training set once and 
+loads it on later calls. Keras is replaced by stand-ins, so that only the
+data handling of train_cnn_model is exercised.
+"""
+import io
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class _Callback(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+def _stub_keras():
+    """Installs minimal keras modules if keras is not available."""
+    try:
+        import keras # noqa: F401
+        return
+    except ImportError:
+        pass
+    
+    modules = {name: types.ModuleType(name) for name in 
+               ['keras', 'keras.models', 'keras.utils', 'keras.callbacks']}
+    modules['keras.models'].load_model = lambda path: path
+    modules['keras.utils'].Sequence = object
+    for name in ['EarlyStopping', 'CSVLogger', 'ModelCheckpoint', 
+                 'TensorBoard', 'ReduceLROnPlateau']:
+        setattr(modules['keras.callbacks'], name, _Callback)
+    sys.modules.update(modules)
+
+
+_stub_keras()
+
+import cnn.training as training # noqa: E402
+from cnn.data_processing import ( # noqa: E402
+    generate_dataset, load_store, store_manifest)
+from cnn.utils import PackedSpikes # noqa: E402
+
+
+class _Model(object):
+    """Records the training set it is fit on."""
+    def fit(self, x, y, **kwargs):
+        self.x = x
+
+
+class TrainStoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.datasets = [(rng.rand(20, 6000) < 0.2).astype(np.int32)*3]
+        self.networks = [rng.choice([-1,0,1], size=(20, 20), p=[.1,.8,.1])]
+        self.parents = [
+            {i: rng.choice(20, 3, replace=False) for i in range(20)}]
+        self.store_dir = tempfile.mkdtemp()
+        self.params = dict(target=600, slice_len=40, thres=15, epochs=1,
+                           logdir=self.store_dir + '/')
+        
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+        
+    def test_store_is_reused(self):
+        generated = []
+        generate_store = training.generate_store
+        
+        def counted(*args, **kwargs):
+            generated.append(1)
+            return generate_store(*args, **kwargs)
+        
+        training.generate_store = counted
+        try:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                for _ in range(2):
+                    training.train_cnn_model(
+                        _Model(), self.datasets, self.networks, 
+                        self.parents, store_dir=self.store_dir, seed=5, 
+                        **self.params)
+        finally:
+            training.generate_store = generate_store
+            
+        self.assertEqual(len(generated), 1)
+        self.assertIn('Loading stored training set', output.getvalue())
+        
+    def test_packed_store_is_reused(self):
+        packed = [PackedSpikes.from_dense(S) for S in self.datasets]
+        # Packed spikes are binary, so the threshold is lowered to match
+        params = dict(self.params, thres=5)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            for _ in range(2):
+                training.train_cnn_model(
+                    _Model(), packed, self.networks, self.parents, 
+                    store_dir=self.store_dir, seed=5, **params)
+                
+        self.assertIn('Loading stored training set', output.getvalue())
+        
+    def test_manifest_detects_changed_data(self):
+        S = self.datasets[0]
+        swapped = S.copy()
+        swapped[:, [0, 1]] = swapped[:, [1, 0]]
+        self.assertFalse((S[:, 0] == S[:, 1]).all())
+        
+        fingerprints = [
+            store_manifest([data], self.networks, self.parents)['fingerprint']
+            for data in [S, swapped, PackedSpikes.from_dense(S), 
+                         PackedSpikes.from_dense(swapped)]]
+        self.assertEqual(len(set(fingerprints)), 4)
+        
+    def test_store_matches_generate_dataset(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            training.train_cnn_model(
+                _Model(), self.datasets, self.networks, self.parents, 
+                store_dir=self.store_dir, seed=5, **self.params)
+            np.random.seed(5)
+            examples = generate_dataset(
+                self.datasets, self.networks, self.parents, mode='train', 
+                target=600, slice_len=40, thres=15)
+            
+        stored = load_store(self.store_dir)
+        for stored_array, array in zip(stored[:5], examples):
+            np.testing.assert_array_equal(stored_array, array)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -103,6 +103,7 @@ data_params = {
 
 # Training data files
 data_path = '/home/paul.herringer/Documents/normal-spike-trains/'
+cache_path = data_path + 'cache/'
 
 times_normal1 = data_path + 'normal-1-inh-times.txt'
 idx_normal1 = data_path + 'normal-1-inh-idx.txt'
@@ -115,12 +116,14 @@ network_normal2 = data_path + 'network_normal-2.txt'
 pts_normal2 = data_path + 'parents_normal2_20ms.pkl'
 
 # Read in spike data, parents and true networks
-spikes_normal1 = read_spike_trains([times_normal1, idx_normal1], timebin=2)
+spikes_normal1 = read_spike_trains(
+    [times_normal1, idx_normal1], timebin=2, cache_dir=cache_path)
 scores_normal1 = read_network(network_normal1, mode='inhibition')
 with open(pts_normal1, 'rb') as inf:
     parents_normal1 = pickle.load(inf)
 
-spikes_normal2 = read_spike_trains([times_normal2, idx_normal2], timebin=2)
+spikes_normal2 = read_spike_trains(
+    [times_normal2, idx_normal2], timebin=2, cache_dir=cache_path)
 scores_normal2 = read_network(network_normal2, mode='inhibition')
 with open(pts_normal2, 'rb') as inf:
     parents_normal2 = pickle.load(inf)
@@ -44,11 +44,13 @@ prediction_params = {
     'slice_len':330,
     'batch_size':256,
     'shuffle_type':'jitter',
-    'num_shuffles':100
+    'num_shuffles':100,
+    'keep_null':'full'
     }
 
 # Validation data files
 data_path = '/home/paul.herringer/Documents/normal-spike-trains/'
+cache_path = data_path + 'cache/'
 
 times_normal3 = data_path + 'normal-3-inh-times.txt'
 idx_normal3 = data_path + 'normal-3-inh-idx.txt'
@@ -59,7 +61,8 @@ pts_normal3 = data_path + 'parents2_normal3.pkl'
 logdir = '/home/paul.herringer/Documents/connectomics/cnn-parents/bn_prelu-5ms-2x10/'
 
 # Read in spike data, true network and parents, downsample spikes
-spikes_normal3 = read_spike_trains([times_normal3, idx_normal3], timebin=params['timebin'])
+spikes_normal3 = read_spike_trains(
+    [times_normal3, idx_normal3], timebin=params['timebin'], cache_dir=cache_path)
 ds_spikes = downsample_spikes(spikes_normal3)
 true_scores = read_network(network_normal3, mode='inhibition')
 with open(pts_normal3, 'rb') as inf: